@@ -0,0 +1,136 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import config
+import csv
+import cv2
+import fetch
+import framestore
+import os
+import snowstakeimage
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+columns = ['timestamp', 'inches', 'rotation', 'box_xpos', 'box_ypos']
+
+
+def frame_times(start, end):
+    # Timecam publishes a frame every 5 minutes
+    t = start.replace(second=0, microsecond=0)
+    if t.minute % 5 or t < start:
+        t += timedelta(minutes=5 - t.minute % 5)
+    while t < end:
+        yield t
+        t += timedelta(minutes=5)
+
+
+# Frames of a resort in a local directory named like the timecam files
+def directory_frames(resort, directory, start, end):
+    prefix = os.path.basename(config.get().resorts[resort].url).split('##')[0]
+    frames = []
+    for name in os.listdir(directory):
+        t = framestore.frame_time(name)
+        if name.startswith(prefix) and t is not None and start <= t < end:
+            frames.append((t, os.path.join(directory, name)))
+    return sorted(frames)
+
+
+def _init_worker():
+    # One frame per process, don't let OpenCV oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+_store = None
+
+
+# Historical frames are kept apart from the live store, a backfill never evicts live frames
+def store():
+    global _store
+    cfg = config.get().frames
+    if _store is None or _store.cfg is not cfg:
+        _store = framestore.FrameStore(cfg, cfg.backfill_path)
+    return _store
+
+
+# Frame of a (resort, time, path) task, from path, either frame store or timecam
+def load(task):
+    resort, frame_time, path = task
+    if path is not None:
+        with open(path, 'rb') as f:
+            return f.read()
+    data = framestore.store().get(resort, frame_time)
+    if data is None:
+        data = store().get(resort, frame_time)
+    if data is None:
+        data = fetch.get_content(framestore.timecam_url(config.get().resorts[resort].url, frame_time))
+        store().put(resort, frame_time, data)
+    return data
+
+
+# Tasks for the frames of a resort between start and end, from directory or timecam
+def tasks(resort, start, end, directory=None):
+    if directory:
+        return [(resort, t, path) for t, path in directory_frames(resort, directory, start, end)]
+    return [(resort, t, None) for t in frame_times(start, end)]
+
+
+def measure(task):
+    resort, frame_time, path = task
+    try:
+        s = snowstakeimage.get_detector(resort)(fetch.decode_image(load(task)), time=frame_time)
+        # Historical frames are calibrated individually rather than against the live calibration
+        s.analyze(cached=False)
+    except Exception as e:
+        print(f'{resort} {frame_time.isoformat()}: {e}', file=sys.stderr)
+        return None
+    # Box origin in render-scale (5x) pixels like config.json
+    factor = s.render_scale / s.analysis_scale
+    return [frame_time.isoformat(), s.inches, round(s.rotation, 4),
+            int(round(s.box_xpos * factor)), int(round(s.box_ypos * factor))]
+
+
+# Timestamps already in the output, so an interrupted backfill picks up where it left off
+def completed(output):
+    try:
+        with open(output, newline='') as f:
+            return {row['timestamp'] for row in csv.DictReader(f)}
+    except FileNotFoundError:
+        return set()
+
+
+def backfill(resort, start, end, output, directory=None, workers=None):
+    done = completed(output)
+    todo = [task for task in tasks(resort, start, end, directory) if task[1].isoformat() not in done]
+
+    new = not os.path.exists(output) or os.path.getsize(output) == 0
+    with open(output, 'a', newline='') as f, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(columns)
+        # Results come back in frame order, each one is written out as soon as it's ready
+        for row in pool.map(measure, todo, chunksize=4):
+            if row is not None:
+                writer.writerow(row)
+                f.flush()
+    return len(todo)
+
+
+def parse_time(value):
+    t = datetime.fromisoformat(value)
+    return t.replace(tzinfo=timezone.utc) if t.tzinfo is None else t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure snow depth over a range of past timecam frames')
+    parser.add_argument('resort')
+    parser.add_argument('start', type=parse_time, help='UTC start, e.g. 2022-12-14 or 2022-12-14T06:00')
+    parser.add_argument('end', type=parse_time, help='UTC end, exclusive')
+    parser.add_argument('-o', '--output', help='CSV file, defaults to <resort>.csv')
+    parser.add_argument('-d', '--directory', help='read frames from this directory instead of timecam')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    count = backfill(args.resort, args.start, args.end, args.output or f'{args.resort}.csv',
+                     directory=args.directory, workers=args.workers)
+    print(f'{count} frames processed')
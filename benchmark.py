@@ -0,0 +1,202 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import calibration
+import fetch
+import json
+import os
+import snowstakeimage
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import join
+
+# Bundled reference frames: (resort, file, expected inches, expected rotation)
+# Rotations are those of the original pipeline, which analysed every frame upscaled to 5x
+# The Vail 13:05 frame was labelled as 10" but the detector has always read 5" from it
+references = [
+    ('vail', 'vail-official-snow-stake~640_2022_12_14_13_10_00_00.jpg', 0, -0.49),
+    ('vail', 'vail-official-snow-stake~640_2022_12_14_13_05_00_00.jpg', 5, -1.65),
+    ('breckenridge', 'breckenridge-snowstake-ca~640_2022_12_20_04_50_00_00.jpg', 0, -0.72),
+    ('breckenridge', 'breckenridge-snowstake-ca~640_2022_12_19_04_50_00_00.jpg', 0, -4.13),
+    ('breckenridge', 'breckenridge-snowstake-ca~640_2022_12_21_12_05_00_00.jpg', 2, -4.92),
+]
+
+rotation_tolerance = 0.5
+
+# Modules behind each entry point, imported in a fresh interpreter to time startup
+entry_points = ['main', 'vail.vail', 'breckenridge.breckenridge', 'backfill', 'history']
+
+# SnowStakeImage methods timed individually, auto_adjust includes its own rotate
+stages = ['auto_adjust', 'rotate', 'create_boxes', 'detect_snow', 'upscale', 'draw_snowline',
+          'attach_datetime_text', 'attach_resort_text', 'draw_text']
+
+
+def _no_network(*args, **kwargs):
+    raise RuntimeError('network access is disabled while benchmarking')
+
+
+class StageTimer:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.times = {}
+        self.peaks = {}
+
+    def measure(self, name, func, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] - start_memory
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+        return result
+
+    # Routes the instance's stage methods through measure, nested calls are timed too
+    def instrument(self, s):
+        for name in stages:
+            func = getattr(s, name)
+            setattr(s, name, lambda *args, name=name, func=func, **kwargs: self.measure(name, func, *args, **kwargs))
+
+
+# Live pipeline of SnowStakeImage.run() on one frame, without the calibration cache
+def process(resort, data, timer):
+    im = timer.measure('decode', fetch.decode_image, data)
+    s = timer.measure('init', snowstakeimage.get_detector(resort), im)
+    timer.instrument(s)
+    s.analyze(cached=False)
+    s.upscale()
+    s.draw_snowline()
+    s.attach_datetime_text(10, 50, 'left', 'la', 200)
+    s.attach_resort_text()
+    s.draw_text()
+    return s
+
+
+def run(repeat):
+    report = []
+    tracemalloc.start()
+    for resort, name, inches, rotation in references:
+        with open(join(resort, name), 'rb') as f:
+            data = f.read()
+
+        # Memory is traced on its own pass as tracing slows everything down
+        memory = StageTimer(trace_memory=True)
+        s = process(resort, data, memory)
+        tracemalloc.stop()
+        timings = []
+        for _ in range(repeat):
+            timer = StageTimer()
+            process(resort, data, timer)
+            timings.append(timer.times)
+        tracemalloc.start()
+
+        report.append({
+            'resort': resort,
+            'file': name,
+            'inches': s.inches,
+            'expected_inches': inches,
+            'rotation': round(s.rotation, 4),
+            'expected_rotation': rotation,
+            'accurate': s.inches == inches and abs(s.rotation - rotation) <= rotation_tolerance,
+            'stages': {stage: {'ms': round(statistics.median(t[stage] for t in timings) * 1000, 3),
+                               'peak_kb': round(memory.peaks[stage] / 1024, 1)}
+                       for stage in memory.times},
+            'total_ms': round(statistics.median(sum(t.values()) - t.get('rotate', 0) for t in timings) * 1000, 3),
+        })
+    tracemalloc.stop()
+    return report
+
+
+# Calibration reuse: every frame is analysed again right after each frame of its resort saved its
+# calibration, and has to read what the full pass read. Calibrations are kept in a scratch directory
+def cached(report):
+    frames = {}
+    for resort, name, _, _ in references:
+        with open(join(resort, name), 'rb') as f:
+            frames[name] = resort, fetch.decode_image(f.read())
+    live_path = calibration.path
+    with tempfile.TemporaryDirectory() as directory:
+        calibration.path = lambda resort: join(directory, f'{resort}.npz')
+        try:
+            for frame in report:
+                frame['cached_inches'] = {}
+                for source, (resort, im) in frames.items():
+                    if resort != frame['resort']:
+                        continue
+                    if os.path.exists(calibration.path(resort)):
+                        os.remove(calibration.path(resort))
+                    snowstakeimage.get_detector(resort)(im).analyze()
+                    s = snowstakeimage.get_detector(resort)(frames[frame['file']][1]).analyze()
+                    frame['cached_inches'][source] = s.inches
+                frame['cached_accurate'] = all(inches == frame['inches'] for inches in frame['cached_inches'].values())
+        finally:
+            calibration.path = live_path
+            calibration._calibrations.clear()
+
+
+# Median seconds for a fresh interpreter to import each entry point, interpreter startup included
+def startup(repeat):
+    times = {}
+    for module in entry_points:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', f'import {module}'], check=True)
+            runs.append(time.perf_counter() - start)
+        times[module] = statistics.median(runs)
+    return times
+
+
+# Regressions against a saved report: accuracy failures and frames slower by more than slowdown
+def compare(report, baseline, slowdown):
+    previous = {(frame['resort'], frame['file']): frame for frame in baseline}
+    problems = []
+    for frame in report:
+        key = (frame['resort'], frame['file'])
+        if not frame['accurate']:
+            problems.append(f'{frame["file"]}: read {frame["inches"]}" at {frame["rotation"]} deg, expected '
+                            f'{frame["expected_inches"]}" at {frame["expected_rotation"]} deg')
+        if key in previous and frame['total_ms'] > previous[key]['total_ms'] * slowdown:
+            problems.append(f'{frame["file"]}: {frame["total_ms"]}ms, baseline {previous[key]["total_ms"]}ms')
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy and per-stage latency over the bundled reference frames')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='report to write')
+    parser.add_argument('-b', '--baseline', help='saved report to compare against')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='timed runs per frame')
+    parser.add_argument('--slowdown', type=float, default=1.25, help='allowed total time ratio to the baseline')
+    parser.add_argument('--startup', action='store_true', help='time entry point imports instead')
+    args = parser.parse_args()
+
+    if args.startup:
+        for module, seconds in startup(args.repeat).items():
+            print(f'{module}: {seconds * 1000:.0f}ms')
+        sys.exit(0)
+
+    fetch.session().request = _no_network
+    report = run(args.repeat)
+    cached(report)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    for frame in report:
+        print(f'{frame["file"]}: {frame["inches"]}" {frame["rotation"]} deg {frame["total_ms"]}ms '
+              f'{"ok" if frame["accurate"] else "INACCURATE"}'
+              f'{"" if frame["cached_accurate"] else ", CACHED CALIBRATION DISAGREES"}')
+
+    problems = [f'{frame["file"]}: inaccurate' for frame in report if not frame['accurate']]
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(report, json.load(f), args.slowdown)
+    problems += [f'{frame["file"]}: read {inches}" with the calibration of {source}, {frame["inches"]}" without'
+                 for frame in report for source, inches in frame['cached_inches'].items() if inches != frame['inches']]
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
@@ -1,44 +1,53 @@
 # Copyright (c) 2022, Jonathan Derrick
 # SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import backfill
+import framestore
 import lib
-from snowstakeimage import SnowStakeImage
+import server
+from snowstakeimage import SnowStakeImage, register
 import cv2
 import math
+import sys
 import time
 import numpy as np
+from datetime import datetime, timedelta, timezone
 from os.path import join
 from PIL import Image
 from statistics import mean
 
 
+@register('breckenridge')
 class Breckenridge(SnowStakeImage):
-    def __init__(self, im):
-        super().__init__(im, 'breckenridge')
+    # The stake markings are too thin to survive the morphology at native resolution
+    analysis_scale = 2
+    # HLS bounds of the white stake markings
+    lower = np.uint8([0, 180, 0])
+    upper = np.uint8([255, 255, 255])
 
-    def auto_adjust(self):
+    def __init__(self, im, analysis_scale=None, time=None):
+        super().__init__(im, 'breckenridge', analysis_scale, time)
+
+    # Positions and kernels are in render-scale (5x) pixels and scaled to the analysed frame
+    def measure_rotation(self):
         im = cv2.cvtColor(self.im, cv2.COLOR_RGB2HLS)
-        lower = np.uint8([0, 180, 0])
-        upper = np.uint8([255, 255, 255])
-        mask = cv2.inRange(im, lower, upper)
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
-        im = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        mask = cv2.inRange(im, self.lower, self.upper)
+        im = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel(5))
 
         # Crop can't be too tall as snow might interfere
-        ypos = 200
-        xpos = 1300
-        height = 500
-        width = 500
+        ypos = self.scaled(200)
+        xpos = self.scaled(1300)
+        height = self.scaled(500)
+        width = self.scaled(500)
         crop_im = im[ypos:ypos + height, xpos:xpos + width]
-        crop_im = cv2.dilate(crop_im, kernel, iterations=4)
-        crop_im = cv2.erode(crop_im, kernel, iterations=8)
+        # Equivalent to 4 dilations and 8 erosions with the 5x5 kernel
+        crop_im = cv2.dilate(crop_im, self.kernel(17))
+        crop_im = cv2.erode(crop_im, self.kernel(33))
 
         stride = int(height / 12) - 1
-        dist = []
-        for y in range(0, height, stride):
-            for x in range(0, width):
-                if crop_im[y][x] == 255:
-                    dist.append((y, x))
-                    break
+        rows = np.arange(0, height, stride)
+        xs = lib.first_hits(crop_im[rows] == 255)
+        dist = [(y, x) for y, x in zip(rows.tolist(), xs.tolist()) if x >= 0]
 
         # Trig: tan N = opposite / adjacent
         rotations = []
@@ -46,68 +55,66 @@ class Breckenridge(SnowStakeImage):
             oa = (dist[i + 1][1] - dist[i][1]) / (dist[i + 1][0] - dist[i][0])
             rotations.append(math.atan(oa) * 180 / math.pi)
         rotations = lib.reject_outliers(rotations)
-        self.rotation = -mean(rotations)
+        return -mean(rotations)
+
+    def auto_adjust(self):
+        self.rotation = self.measure_rotation()
         self.rotate(self.rotation)
 
         # Now determine x/y adjust
-        ypos = 200
-        xpos = 1300
-        height = 300
-        width = 500
+        ypos = self.scaled(200)
+        xpos = self.scaled(1300)
+        height = self.scaled(300)
+        width = self.scaled(500)
         im = cv2.cvtColor(self.im, cv2.COLOR_RGB2HLS)
-        mask = cv2.inRange(im, lower, upper)
-        im = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        mask = cv2.inRange(im, self.lower, self.upper)
+        im = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel(5))
         crop_im = im[ypos:ypos + height, xpos:xpos + width]
-        crop_im = cv2.dilate(crop_im, kernel, iterations=4)
+        crop_im = cv2.dilate(crop_im, self.kernel(17))
 
         # 2-pass search
         # 1st pass, find top of stake (or snow)
         x = int(width / 2)
-        for y in range(0, height):
-            if crop_im[y][x] == 255:
-                self.box_ypos = ypos + y
-                break
+        y = lib.first_hit(crop_im[:height, x] == 255)
+        if y >= 0:
+            self.box_ypos = ypos + y
+        else:
+            y = height - 1
 
         # 2nd pass, find left side of stake
         height, width = crop_im.shape
-        stride = int((height - y) / 8) - 1
-        xvals = []
-        for y in range(y, height, stride):
-            for x in range(0, width):
-                if crop_im[y][x] == 255:
-                    xvals.append(x)
-                    break
-        x = int(mean(lib.reject_outliers(xvals)))
+        stride = max(1, int((height - y) / 8) - 1)
+        xvals = lib.first_hits(crop_im[y:height:stride] == 255)
+        x = int(mean(lib.reject_outliers(xvals[xvals >= 0].tolist())))
         self.box_xpos = x + xpos
 
         # Find top of stake from left
-        for y in range(0, height):
-            if crop_im[y][x + 5] == 255:
-                self.box_ypos = ypos + y
-                break
+        y = lib.first_hit(crop_im[:, x + self.scaled(5)] == 255)
+        if y >= 0:
+            self.box_ypos = ypos + y
 
     def detect_snow(self):
         # Snow adds color consistency creating a solid blue hsv layer
         # Non-snow images have inch markers in green in the hsv layer
         lower_green = np.array([45, 0, 0])
         upper_green = np.array([180, 255, 255])
-        for i in range(len(self.boxes)):
-            (spos, epos) = (self.boxes[str(i)][0], self.boxes[str(i)][1])
-            box = self.im[spos[1]:epos[1], spos[0]:epos[0]]
-            mask = cv2.inRange(box, lower_green, upper_green)
-            # Image.fromarray(mask).show()
-            # time.sleep(1)
-            # Image.fromarray(box).show()
-            # time.sleep(1)
-            # print(i, np.count_nonzero(mask))
-            if np.count_nonzero(mask) > 100:
-                self.inches = i
-                return i
-
-
-def run_breckenridge():
-    im = None
 
+        # One mask of the region under the boxes, every box is counted from it
+        boxes, (x0, y0, x1, y1) = self.box_region()
+        mask = cv2.inRange(self.im[y0:y1, x0:x1], lower_green, upper_green)
+        counts = lib.box_counts(mask, boxes, (x0, y0))
+        # Image.fromarray(mask).show()
+        # print(counts)
+        i = lib.first_hit(counts > self.scaled_area(100))
+        if i >= 0:
+            self.inches = i
+            return i
+
+    def attach_resort_text(self):
+        self.attach_inches_text(380, self.im.shape[1] - 100, f'{self.inches}"', 'right', 'rs', 500)
+
+
+def run_breckenridge(im=None, time=None, cached=True):
     # No-snow reference image
     # im = Image.open(join('breckenridge', 'breckenridge-snowstake-ca~640_2022_12_20_04_50_00_00.jpg'))
 
@@ -118,16 +125,7 @@ def run_breckenridge():
     # 2-3 inch snow reference image
     # im = Image.open(join('breckenridge', 'breckenridge-snowstake-ca~640_2022_12_21_12_05_00_00.jpg'))
 
-    s = Breckenridge(im)
-    s.auto_adjust()
-    s.create_boxes()
-    s.detect_snow()
-    # s.draw_boxes()
-    s.draw_snowline()
-    s.resize_and_crop()
-    s.attach_datetime_text(10, 50, 'left', 'la', 200)
-    s.attach_inches_text(380, s.im.shape[1] - 100, f'{s.inches}"', 'right', 'rs', 500)
-    return s
+    return Breckenridge(im, time=time).run(cached)
 
 
 def get_image():
@@ -136,9 +134,36 @@ def get_image():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Breckenridge snow stake, refreshed every 5 minutes')
+    parser.add_argument('--headless', action='store_true', help='serve frames over HTTP instead of showing them')
+    parser.add_argument('--replay', action='store_true', help='replay stored frames with no network access')
+    parser.add_argument('--start', type=backfill.parse_time, help='UTC start of the replay, defaults to an hour ago')
+    parser.add_argument('--end', type=backfill.parse_time, help='UTC end of the replay, defaults to now')
+    parser.add_argument('--interval', type=float, default=1, help='seconds between replayed frames')
+    args = parser.parse_args()
+
+    frames = None
+    if args.headless:
+        frames = server.FrameServer()
+        frames.start()
+
+    def output(s):
+        if frames:
+            frames.publish('breckenridge', s.im)
+        else:
+            s.show()
+
+    # Old frames are calibrated individually and leave the live calibration alone
+    # Paced and limited to a range, every frame opens a viewer unless headless
+    if args.replay:
+        start = args.start or datetime.now(timezone.utc) - timedelta(hours=1)
+        for frame_time, path in framestore.store().frames('breckenridge', start, args.end):
+            output(run_breckenridge(Image.open(path), frame_time, cached=False))
+            time.sleep(args.interval)
+        sys.exit(0)
+
     # Runs every 5 minutes, avoiding drift
     start_time = time.time()
     while True:
-        s = run_breckenridge()
-        s.show()
+        output(run_breckenridge())
         time.sleep(300 - ((time.time() - start_time) % 300))
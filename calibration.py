@@ -0,0 +1,95 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import config
+import cv2
+import numpy as np
+import os
+import threading
+import time
+
+# Saved calibrations by resort as (mtime, calibration), read again once another process saves a new one
+_calibrations = {}
+
+
+def path(resort):
+    return os.path.join(config.get().calibration.path, f'{resort}.npz')
+
+
+def load(resort):
+    try:
+        mtime = os.stat(path(resort)).st_mtime_ns
+    except OSError:
+        return None
+    cached = _calibrations.get(resort)
+    if cached is None or cached[0] != mtime:
+        try:
+            with np.load(path(resort)) as f:
+                cached = _calibrations[resort] = mtime, {key: f[key] for key in f.files}
+        except (OSError, ValueError):
+            return None
+    return cached[1]
+
+
+def save(resort, calibration):
+    os.makedirs(config.get().calibration.path, exist_ok=True)
+    # Write then rename so other processes never load a partial file
+    tmp = f'{path(resort)}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+    np.savez(tmp, **calibration)
+    os.replace(tmp, path(resort))
+    _calibrations[resort] = os.stat(path(resort)).st_mtime_ns, calibration
+
+
+# Grayscale region around the top of the stake, where snow doesn't reach
+def patch_region(s):
+    height, width, _ = s.im.shape
+    x0 = max(0, s.box_xpos - s.scaled(100))
+    y0 = max(0, s.box_ypos - s.scaled(150))
+    x1 = min(width, s.box_xpos + s.scaled(100))
+    y1 = min(height, s.box_ypos + s.scaled(150))
+    return x0, y0, x1, y1
+
+
+# Calibration of an auto_adjust-ed SnowStakeImage, with the stake patch used to check later frames
+def create(s):
+    x0, y0, x1, y1 = patch_region(s)
+    return {
+        'time': np.float64(time.time()),
+        'analysis_scale': np.float64(s.analysis_scale),
+        'rotation': np.float64(s.rotation),
+        'box_xpos': np.int64(s.box_xpos),
+        'box_ypos': np.int64(s.box_ypos),
+        'patch_origin': np.array([x0, y0]),
+        'patch': cv2.cvtColor(s.im[y0:y1, x0:x1], cv2.COLOR_RGB2GRAY),
+    }
+
+
+def is_current(calibration, analysis_scale):
+    age = time.time() - float(calibration['time'])
+    return float(calibration['analysis_scale']) == analysis_scale and \
+        age < config.get().calibration.max_age_hours * 60 * 60
+
+
+# Looks for the saved stake patch near its saved position in a frame already rotated by the saved rotation
+# rotation is the stake's, measured before the frame was rotated. The patch is too small to show the
+# stake turning in place, so it is compared with the saved rotation too
+# Returns how far the stake moved as (dx, dy), or None if it can't be found or has turned
+def drift(s, calibration, rotation):
+    if abs(rotation - float(calibration['rotation'])) > config.get().calibration.rotation_tolerance:
+        return None
+    patch = calibration['patch']
+    px, py = (int(v) for v in calibration['patch_origin'])
+    margin = s.scaled(50)
+    height, width, _ = s.im.shape
+    x0 = max(0, px - margin)
+    y0 = max(0, py - margin)
+    x1 = min(width, px + patch.shape[1] + margin)
+    y1 = min(height, py + patch.shape[0] + margin)
+    if patch.size == 0 or x1 - x0 < patch.shape[1] or y1 - y0 < patch.shape[0]:
+        return None
+
+    search = cv2.cvtColor(s.im[y0:y1, x0:x1], cv2.COLOR_RGB2GRAY)
+    result = cv2.matchTemplate(search, patch, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (x, y) = cv2.minMaxLoc(result)
+    if score < config.get().calibration.threshold:
+        return None
+    return x + x0 - px, y + y0 - py
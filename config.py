@@ -0,0 +1,240 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import json
+import os
+from dataclasses import dataclass
+from types import MappingProxyType
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Box:
+    height: int
+    width: int
+
+
+@dataclass(frozen=True)
+class Resort:
+    name: str
+    latitude: str
+    longitude: str
+    url: str
+    rotation: float
+    inches: int
+    box: Box
+    # Module that registers the resort's SnowStakeImage subclass, imported on first use
+    module: str
+
+
+@dataclass(frozen=True)
+class Frames:
+    # Directory of stored timecam frames, one subdirectory per resort
+    path: str
+    max_age_days: float
+    max_bytes: int
+    # Serve frames from the store only, never from the network
+    replay: bool
+    # Separate store for the historical frames of backfills and timelapses
+    backfill_path: str
+
+
+@dataclass(frozen=True)
+class Calibration:
+    # Directory of saved per-resort calibrations
+    path: str
+    # Full recalibration is forced once a calibration is this old
+    max_age_hours: float
+    # Minimum normalized correlation of the stake patch for a calibration to be reused
+    threshold: float
+    # Degrees the stake may have turned since calibration for it to be reused
+    rotation_tolerance: float
+
+
+@dataclass(frozen=True)
+class History:
+    # Directory of per-resort measurement histories
+    path: str
+    # Measurements kept per resort, the oldest are overwritten once it's full
+    capacity: int
+    # Trailing window the displayed reading is smoothed over
+    smoothing_minutes: float
+
+
+@dataclass(frozen=True)
+class Metrics:
+    enabled: bool
+    # JSON lines event log, appended to on every export
+    jsonl: str
+    # Size at which the event log is rotated to <jsonl>.1, replacing the previous rotation
+    jsonl_max_bytes: int
+    # Prometheus textfile for the node_exporter textfile collector, rewritten on every export
+    textfile: str
+
+
+@dataclass(frozen=True)
+class Server:
+    host: str
+    port: int
+    # Encodings produced for every frame, out of jpg and png
+    formats: tuple
+
+
+@dataclass(frozen=True)
+class Config:
+    path: str
+    mtime: float
+    resorts: MappingProxyType
+    weather_ttl: int
+    frames: Frames
+    calibration: Calibration
+    history: History
+    metrics: Metrics
+    server: Server
+
+
+def _field(section, key, kind, where):
+    if key not in section:
+        raise ConfigError(f'{where}.{key} is missing')
+    value = section[key]
+    # bool is an int subclass but never a valid number here
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise ConfigError(f'{where}.{key} has invalid type {type(value).__name__}')
+    return value
+
+
+def _flag(section, key, where):
+    if not isinstance(section[key], bool):
+        raise ConfigError(f'{where}.{key} must be true or false')
+    return section[key]
+
+
+def _positive(value, where):
+    if value <= 0:
+        raise ConfigError(f'{where} must be positive')
+    return value
+
+
+def _parse_resort(name, section):
+    where = f'resorts.{name}'
+    if not isinstance(section, dict):
+        raise ConfigError(f'{where} must be an object')
+    box = _field(section, 'box', dict, where)
+    return Resort(name=name,
+                  latitude=str(_field(section, 'latitude', (str, int, float), where)),
+                  longitude=str(_field(section, 'longitude', (str, int, float), where)),
+                  url=_field(section, 'url', str, where),
+                  rotation=float(_field(section, 'rotation', (int, float), where)),
+                  inches=_positive(_field(section, 'inches', int, where), f'{where}.inches'),
+                  box=Box(height=_positive(_field(box, 'height', int, f'{where}.box'), f'{where}.box.height'),
+                          width=_positive(_field(box, 'width', int, f'{where}.box'), f'{where}.box.width')),
+                  module=_field(section, 'module', str, where) if 'module' in section else f'{name}.{name}')
+
+
+def _parse_frames(section, where):
+    if not isinstance(section, dict):
+        raise ConfigError(f'{where} must be an object')
+    return Frames(path=_field(section, 'path', str, where) if 'path' in section else 'frames',
+                  max_age_days=_positive(float(_field(section, 'max_age_days', (int, float), where)),
+                                         f'{where}.max_age_days') if 'max_age_days' in section else 30.,
+                  max_bytes=_positive(_field(section, 'max_bytes', int, where),
+                                      f'{where}.max_bytes') if 'max_bytes' in section else 1 << 30,
+                  replay=_flag(section, 'replay', where) if 'replay' in section else False,
+                  backfill_path=_field(section, 'backfill_path', str, where)
+                  if 'backfill_path' in section else 'frames-backfill')
+
+
+def _parse_calibration(section, where):
+    if not isinstance(section, dict):
+        raise ConfigError(f'{where} must be an object')
+    return Calibration(path=_field(section, 'path', str, where) if 'path' in section else 'calibration',
+                       max_age_hours=_positive(float(_field(section, 'max_age_hours', (int, float), where)),
+                                               f'{where}.max_age_hours') if 'max_age_hours' in section else 6.,
+                       threshold=float(_field(section, 'threshold', (int, float), where))
+                       if 'threshold' in section else .8,
+                       rotation_tolerance=_positive(float(_field(section, 'rotation_tolerance', (int, float), where)),
+                                                    f'{where}.rotation_tolerance')
+                       if 'rotation_tolerance' in section else .5)
+
+
+def _parse_history(section, where):
+    if not isinstance(section, dict):
+        raise ConfigError(f'{where} must be an object')
+    return History(path=_field(section, 'path', str, where) if 'path' in section else 'history',
+                   capacity=_positive(_field(section, 'capacity', int, where),
+                                      f'{where}.capacity') if 'capacity' in section else 5 * 365 * 24 * 12,
+                   smoothing_minutes=_positive(float(_field(section, 'smoothing_minutes', (int, float), where)),
+                                               f'{where}.smoothing_minutes')
+                   if 'smoothing_minutes' in section else 30.)
+
+
+def _parse_metrics(section, where):
+    if not isinstance(section, dict):
+        raise ConfigError(f'{where} must be an object')
+    return Metrics(enabled=_flag(section, 'enabled', where) if 'enabled' in section else False,
+                   jsonl=_field(section, 'jsonl', str, where) if 'jsonl' in section else 'metrics.jsonl',
+                   jsonl_max_bytes=_positive(_field(section, 'jsonl_max_bytes', int, where),
+                                             f'{where}.jsonl_max_bytes')
+                   if 'jsonl_max_bytes' in section else 16 << 20,
+                   textfile=_field(section, 'textfile', str, where) if 'textfile' in section else 'snowcam.prom')
+
+
+def _parse_server(section, where):
+    if not isinstance(section, dict):
+        raise ConfigError(f'{where} must be an object')
+    formats = tuple(_field(section, 'formats', list, where)) if 'formats' in section else ('jpg',)
+    if not formats or any(f not in ('jpg', 'png') for f in formats):
+        raise ConfigError(f'{where}.formats must list jpg and/or png')
+    return Server(host=_field(section, 'host', str, where) if 'host' in section else '127.0.0.1',
+                  port=_positive(_field(section, 'port', int, where), f'{where}.port') if 'port' in section else 8080,
+                  formats=formats)
+
+
+def load(path='config.json'):
+    try:
+        mtime = os.stat(path).st_mtime
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f'{path}: {e}') from e
+
+    resorts = _field(data, 'resorts', dict, path)
+    if not resorts:
+        raise ConfigError(f'{path}: no resorts configured')
+    weather = data.get('weather', {})
+    weather_ttl = _field(weather, 'ttl', int, f'{path}.weather') if 'ttl' in weather else 1800
+    return Config(path=path, mtime=mtime,
+                  resorts=MappingProxyType({name: _parse_resort(name, section) for name, section in resorts.items()}),
+                  weather_ttl=weather_ttl,
+                  frames=_parse_frames(data.get('frames', {}), f'{path}.frames'),
+                  calibration=_parse_calibration(data.get('calibration', {}), f'{path}.calibration'),
+                  history=_parse_history(data.get('history', {}), f'{path}.history'),
+                  metrics=_parse_metrics(data.get('metrics', {}), f'{path}.metrics'),
+                  server=_parse_server(data.get('server', {}), f'{path}.server'))
+
+
+_config = None
+
+
+# Shared configuration, parsed on first use
+def get():
+    global _config
+    if _config is None:
+        _config = load()
+    return _config
+
+
+# Re-parse the file if it changed on disk since it was loaded
+# A broken edit keeps the previous configuration in place
+def reload():
+    global _config
+    if _config is None:
+        return get()
+    try:
+        if os.stat(_config.path).st_mtime != _config.mtime:
+            _config = load(_config.path)
+    except (OSError, ConfigError) as e:
+        print(e)
+    return _config
@@ -0,0 +1,79 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import cv2
+import metrics
+import numpy as np
+from urllib.parse import urlparse
+
+# (connect, read) seconds
+TIMEOUT = (5, 30)
+
+_session = None
+
+
+# Shared by every request so connections to timecam and Open-Meteo are kept alive and reused
+# requests is only imported on the first request, replayed and cached runs never pay for it
+def session():
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                              max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                                                allowed_methods=('GET', 'HEAD')))
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+# JPEG DCT downscaling done by the decoder itself
+_reduced = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    host = urlparse(url).hostname
+    with metrics.timer('fetch', host=host):
+        r = session().get(url, **kwargs)
+    metrics.count('fetch_requests', host=host, status=r.status_code)
+    if not kwargs.get('stream'):
+        metrics.count('fetch_bytes', len(r.content), host=host)
+    return r
+
+
+# Whether url exists, without downloading it
+def exists(url):
+    host = urlparse(url).hostname
+    with metrics.timer('fetch', host=host, method='HEAD'):
+        r = session().head(url, timeout=TIMEOUT, allow_redirects=True)
+    metrics.count('fetch_requests', host=host, status=r.status_code, method='HEAD')
+    return r.status_code == 200
+
+
+# Decodes encoded image bytes straight into an RGB ndarray, optionally reduced 2, 4 or 8 times
+@metrics.timed('decode')
+def decode_image(data, reduce=1):
+    if reduce not in _reduced:
+        raise ValueError(f'unsupported reduction {reduce}')
+    im = cv2.imdecode(np.frombuffer(data, np.uint8), _reduced[reduce])
+    if im is None:
+        raise ValueError('unable to decode image')
+    return cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+
+
+def get_content(url):
+    r = get(url)
+    r.raise_for_status()
+    return r.content
+
+
+def get_image(url, reduce=1):
+    return decode_image(get_content(url), reduce)
@@ -0,0 +1,218 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import config
+import fetch
+import metrics
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# Timecam frame names end in _YYYY_MM_DD_HH_MM_00_00.jpg, in UTC
+_name_time = re.compile(r'_(\d{4})_(\d{2})_(\d{2})_(\d{2})_(\d{2})_00_00\.jpg$')
+
+
+def timecam_url(url, frame_time):
+    hour = frame_time.strftime('%Y_%m_%d_%H')
+    minute = hour + frame_time.strftime('_%M')
+    url = url.replace('##HOUR##', hour)
+    url = url.replace('##MINUTE##', minute)
+    return url
+
+
+def frame_time(name):
+    m = _name_time.search(name)
+    if m is None:
+        return None
+    return datetime(*map(int, m.groups()), tzinfo=timezone.utc)
+
+
+# Downloaded frames stored under <path>/<resort>/ with their timecam file names
+# Frames older than max_age_days are dropped, then the oldest until the store is down to low_water
+# of max_bytes, leaving room for many puts before the next full rescan
+# The store is only rescanned every evict_every puts or once the bytes put take it over max_bytes
+class FrameStore:
+    evict_every = 100
+    low_water = .9
+    # Seconds after which a .tmp file is taken to be left over by an interrupted put
+    stale_tmp = 60 * 60
+
+    def __init__(self, cfg, root=None):
+        self.cfg = cfg
+        self.root = cfg.path if root is None else root
+        # Bytes stored at the last scan plus those put since, None until the first scan
+        self.total = None
+        self.puts = 0
+        self.lock = threading.Lock()
+
+    def path(self, resort, frame_time):
+        url = config.get().resorts[resort].url
+        return os.path.join(self.root, resort, os.path.basename(timecam_url(url, frame_time)))
+
+    def get(self, resort, frame_time):
+        try:
+            with open(self.path(resort, frame_time), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, resort, frame_time, data):
+        path = self.path(resort, frame_time)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a partial frame
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.puts += 1
+            if self.total is not None:
+                self.total += len(data)
+            if self.total is None or self.total > self.cfg.max_bytes or self.puts >= self.evict_every:
+                self.evict()
+
+    # Stored frames of a resort as (time, path), oldest first
+    def frames(self, resort, start=None, end=None):
+        try:
+            entries = os.scandir(os.path.join(self.root, resort))
+        except FileNotFoundError:
+            return []
+        frames = []
+        with entries:
+            for entry in entries:
+                t = frame_time(entry.name)
+                if t is None or (start and t < start) or (end and t > end):
+                    continue
+                frames.append((t, entry.path))
+        frames.sort()
+        return frames
+
+    # Newest stored frame no later than before
+    def latest(self, resort, before=None):
+        frames = self.frames(resort, end=before)
+        return frames[-1] if frames else None
+
+    def evict(self):
+        self.puts = 0
+        if not os.path.isdir(self.root):
+            self.total = 0
+            return
+        now = time.time()
+        expiry = now - self.cfg.max_age_days * 24 * 60 * 60
+        files = []
+        total = 0
+        for resort in os.scandir(self.root):
+            if not resort.is_dir():
+                continue
+            for entry in os.scandir(resort.path):
+                tmp = entry.name.endswith('.tmp')
+                if not tmp and not entry.name.endswith('.jpg'):
+                    continue
+                try:
+                    st = entry.stat()
+                    if st.st_mtime < (now - self.stale_tmp if tmp else expiry):
+                        os.remove(entry.path)
+                        continue
+                    if tmp:
+                        # Still being written
+                        continue
+                except FileNotFoundError:
+                    # Evicted concurrently by another process
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.cfg.max_bytes * self.low_water:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
+
+
+# Resort -> learned minutes between a frame's slot and its upload, starting from the old fixed 10 minute lag
+delays = {}
+# Bounds of the learned delay, an outage can't push it past max_delay
+min_delay = 0.
+max_delay = 30.
+# Weight of each new observation in the learned delay
+delay_alpha = .3
+# Slots probed, newest first, before giving up on timecam
+max_probes = 4
+
+
+def slot(t):
+    t = t.replace(second=0, microsecond=0)
+    return t - timedelta(minutes=t.minute % 5)
+
+
+# Newest available frame of a resort as (time, data)
+# Probing starts one slot newer than the learned delay predicts and falls back a slot at a time
+# That first slot is always probed so the delay keeps being learned, older slots already in the
+# store are used without touching the network
+def newest(resort, now=None):
+    store_ = store()
+    now = datetime.now(timezone.utc) if now is None else now
+    delay = delays.get(resort, 10.)
+    candidate = slot(now - timedelta(minutes=max(0., delay - 5)))
+    for i in range(max_probes):
+        data = store_.get(resort, candidate)
+        if data is not None and i > 0:
+            metrics.count('frame_probe', resort=resort, result='stored')
+            return candidate, data
+        url = timecam_url(config.get().resorts[resort].url, candidate)
+        stored = data is not None
+        try:
+            found = fetch.exists(url)
+            if found and not stored:
+                data = fetch.get_content(url)
+        except Exception as e:
+            # Unreachable, older slots won't fare any better
+            print(f'{resort} {candidate.isoformat()}: {e}')
+            if stored:
+                return candidate, data
+            break
+        if i == 0:
+            learn(resort, candidate, now, found)
+        if data is not None:
+            metrics.count('frame_probe', resort=resort, result='stored' if stored else 'found')
+            if not stored:
+                store_.put(resort, candidate, data)
+            return candidate, data
+        metrics.count('frame_probe', resort=resort, result='missing')
+        candidate -= timedelta(minutes=5)
+
+    # Timecam is down or far behind, the last stored frame is better than nothing
+    latest = store_.latest(resort, now)
+    if latest is None:
+        raise FileNotFoundError(f'no frame of {resort} found in the last {max_probes} slots')
+    t, path = latest
+    with open(path, 'rb') as f:
+        return t, f.read()
+
+
+# Learns from the first probe of each call only, it is always a slot newer than the delay predicts
+# Found, the delay is pulled down towards its age, missing, towards the age of the slot after it
+def learn(resort, probed, now, found):
+    age = (now - probed).total_seconds() / 60
+    target = age if found else age + 5
+    delay = delays.get(resort, 10.)
+    if (found and target < delay) or (not found and target > delay):
+        delays[resort] = min(max_delay, max(min_delay, delay + delay_alpha * (target - delay)))
+        metrics.gauge('upload_delay', delays[resort], resort=resort)
+
+
+_store = None
+
+
+# Shared store, recreated when the configuration is reloaded
+def store():
+    global _store
+    cfg = config.get().frames
+    if _store is None or _store.cfg is not cfg:
+        _store = FrameStore(cfg)
+    return _store
@@ -0,0 +1,138 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import config
+import lib
+import numpy as np
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+# One measurement, 24 bytes: a year of 5 minute frames is 2.5MB
+dtype = np.dtype([('time', '<i8'), ('inches', '<f4'), ('rotation', '<f4'),
+                  ('box_xpos', '<i4'), ('box_ypos', '<i4')])
+
+
+def _seconds(t):
+    return int(t.timestamp())
+
+
+# Fixed-size ring buffer of a resort's measurements in a memory-mapped .npy file
+# Unused slots have time 0 and the newest measurement is the one with the highest time,
+# so the file needs no header and a partially written record is at worst one lost measurement
+class History:
+    def __init__(self, resort, cfg):
+        self.cfg = cfg
+        self.path = os.path.join(cfg.path, f'{resort}.npy')
+        self.lock = threading.Lock()
+        os.makedirs(cfg.path, exist_ok=True)
+        try:
+            self.ring = np.lib.format.open_memmap(self.path, mode='r+')
+        except FileNotFoundError:
+            self.ring = np.lib.format.open_memmap(self.path, mode='w+', dtype=dtype, shape=(cfg.capacity,))
+        if self.ring.dtype != dtype or len(self.ring) != cfg.capacity:
+            self.resize()
+        self.head = int(self.ring['time'].argmax())
+
+    # Capacity changed in config.json, the newest measurements are carried over
+    def resize(self):
+        old = self.ring
+        self.head = int(old['time'].argmax())
+        kept = self.ordered()[-self.cfg.capacity:]
+        del self.ring, old
+        tmp = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+        ring = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=(self.cfg.capacity,))
+        ring[:len(kept)] = kept
+        ring.flush()
+        del ring
+        os.replace(tmp, self.path)
+        self.ring = np.lib.format.open_memmap(self.path, mode='r+')
+
+    # Follows appends made through another process's mapping of the file
+    # The slot after the newest record holds the oldest one unless it was written since
+    def sync(self):
+        if self.ring['time'][(self.head + 1) % len(self.ring)] > self.ring['time'][self.head]:
+            self.head = int(self.ring['time'].argmax())
+
+    # The ring as its two time-sorted halves, older first, both views of the ring
+    # Slots past the head are only unused until the ring first wraps, and then all of them are
+    def segments(self):
+        older = self.ring[self.head + 1:] if self.ring['time'][-1] > 0 else self.ring[:0]
+        return older, self.ring[:self.head + 1]
+
+    def ordered(self):
+        return np.concatenate(self.segments())
+
+    def latest(self):
+        self.sync()
+        record = self.ring[self.head]
+        return record if record['time'] else None
+
+    # Measurements no newer than the latest one are dropped, a frame is only recorded once
+    def append(self, time, inches, rotation, box_xpos, box_ypos):
+        with self.lock:
+            self.sync()
+            t = _seconds(time)
+            if t <= self.ring['time'][self.head]:
+                return False
+            self.head = (self.head + 1) % len(self.ring)
+            self.ring[self.head] = (t, inches, rotation, box_xpos, box_ypos)
+            return True
+
+    # Measurements with start <= time <= end, oldest first
+    # Both halves are sorted so each is a binary search and a copy of the matches only
+    def window(self, start=None, end=None):
+        lo = 1 if start is None else max(1, _seconds(start))
+        hi = np.iinfo(np.int64).max if end is None else _seconds(end)
+        with self.lock:
+            self.sync()
+            parts = [part[np.searchsorted(part['time'], lo, 'left'):np.searchsorted(part['time'], hi, 'right')]
+                     for part in self.segments()]
+        return np.concatenate(parts)
+
+    def last(self, hours):
+        return self.window(datetime.now(timezone.utc) - timedelta(hours=hours))
+
+    # Reading at time from the measurements in the trailing smoothing window, glare and shadow
+    # frames are rejected as outliers across it
+    def smoothed(self, time=None, minutes=None):
+        time = datetime.now(timezone.utc) if time is None else time
+        minutes = self.cfg.smoothing_minutes if minutes is None else minutes
+        inches = self.window(time - timedelta(minutes=minutes), time)['inches']
+        if not len(inches):
+            return None
+        return float(np.mean(lib.reject_outliers(inches.astype(np.float64))))
+
+    # Smoothed snowfall over the hours up to time, None without readings at both ends
+    def delta(self, hours=24, time=None):
+        time = datetime.now(timezone.utc) if time is None else time
+        now = self.smoothed(time)
+        then = self.smoothed(time - timedelta(hours=hours))
+        if now is None or then is None:
+            return None
+        return now - then
+
+
+_histories = {}
+
+
+# Shared history of a resort, reopened when the configuration is reloaded
+def get(resort):
+    cfg = config.get().history
+    if resort not in _histories or _histories[resort].cfg is not cfg:
+        _histories[resort] = History(resort, cfg)
+    return _histories[resort]
+
+
+if __name__ == '__main__':
+    for resort in config.get().resorts:
+        h = get(resort)
+        latest = h.latest()
+        if latest is None:
+            print(f'{resort}: no measurements')
+            continue
+        when = datetime.fromtimestamp(int(latest['time'])).strftime('%b %d %Y %-I:%M%p')
+        smoothed = h.smoothed()
+        delta = h.delta()
+        print(f'{resort}: {latest["inches"]:.0f}" at {when}, '
+              f'smoothed {"unknown" if smoothed is None else f"{smoothed:.1f}"}", '
+              f'24h {"unknown" if delta is None else f"{delta:+.1f}"}", {len(h.last(24))} readings in 24h')
@@ -1,6 +1,8 @@
 # Copyright (c) 2022, Jonathan Derrick
 # SPDX-License-Identifier: GPL-3.0-or-later
+import metrics
 import numpy as np
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 
 
@@ -13,25 +15,100 @@ def reject_outliers(data, m=6.):
     return data[s < m].tolist()
 
 
+# Index of the first True in a 1D mask, -1 without one
+def first_hit(mask):
+    i = int(mask.argmax())
+    return i if mask[i] else -1
+
+
+# Index of the first True in each row of a 2D mask, -1 for rows without one
+def first_hits(mask):
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), -1)
+
+
+# Non-zero pixel count of every ((x0, y0), (x1, y1)) box, all read from one summed-area table
+# origin is the position of the mask within the frame the boxes are given in
+def box_counts(mask, boxes, origin=(0, 0)):
+    height, width = mask.shape
+    table = np.zeros((height + 1, width + 1), np.int64)
+    table[1:, 1:] = (mask != 0).cumsum(axis=0).cumsum(axis=1)
+    boxes = np.array([(x0, y0, x1, y1) for (x0, y0), (x1, y1) in boxes]).reshape(-1, 4)
+    boxes -= np.array(origin * 2)
+    x0 = boxes[:, 0].clip(0, width)
+    y0 = boxes[:, 1].clip(0, height)
+    x1 = boxes[:, 2].clip(x0, width)
+    y1 = boxes[:, 3].clip(y0, height)
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+# Fonts are loaded from disk once per (path, size)
+@lru_cache(maxsize=32)
+def load_font(font, font_size):
+    return ImageFont.truetype(font if font else 'NotoSans-Regular.ttf', font_size)
+
+
+# Queues text draws and renders them all in a single numpy->PIL->numpy pass
+class TextLayer:
+    def __init__(self):
+        self.texts = []
+
+    def add_text(self, xy, text, font=None, font_size=15, fill='black',
+                 stroke_fill=None, stroke_width=0, embedded_color=False,
+                 anchor='ms', align='left', spacing=4, direction='ltr'):
+        self.texts.append(dict(xy=xy, text=text, fill=fill, font=load_font(font, font_size),
+                               stroke_fill=stroke_fill, stroke_width=stroke_width, embedded_color=embedded_color,
+                               anchor=anchor, align=align, spacing=spacing, direction=direction))
+
+    @metrics.timed('text')
+    def flush(self, im):
+        if not self.texts:
+            return im
+        pil_im = Image.fromarray(im)
+        draw = ImageDraw.Draw(pil_im)
+        for text in self.texts:
+            draw.text(**text)
+        self.texts.clear()
+        return np.array(pil_im)
+
+
 def add_text(im, xy, text, font=None, font_size=15, fill='black',
              stroke_fill=None, stroke_width=0, embedded_color=False,
              anchor='ms', align='left', spacing=4, direction='ltr'):
-    pil_im = Image.fromarray(im)
-    if font:
-        font = ImageFont.truetype(font, font_size)
-    else:
-        font = ImageFont.truetype('NotoSans-Regular.ttf', font_size)
-    draw = ImageDraw.Draw(pil_im)
-    draw.text(xy=xy, text=text, fill=fill, font=font, stroke_fill=stroke_fill, stroke_width=stroke_width,
-              embedded_color=embedded_color, anchor=anchor, align=align, spacing=spacing, direction=direction)
-    return np.array(pil_im)
+    layer = TextLayer()
+    layer.add_text(xy, text, font=font, font_size=font_size, fill=fill,
+                   stroke_fill=stroke_fill, stroke_width=stroke_width, embedded_color=embedded_color,
+                   anchor=anchor, align=align, spacing=spacing, direction=direction)
+    return layer.flush(im)
+
+
+# Composes panels left to right into a preallocated frame, one per layout of panel sizes
+# Panels shorter than the tallest are padded with white below them
+# The returned frame is only valid until the next compose of the same layout
+class Compositor:
+    # Layouts kept before the oldest buffer is dropped
+    max_layouts = 4
+
+    def __init__(self):
+        self.buffers = {}
+
+    @metrics.timed('combine')
+    def compose(self, *panels):
+        layout = tuple(panel.shape for panel in panels)
+        frame = self.buffers.get(layout)
+        if frame is None:
+            if len(self.buffers) >= self.max_layouts:
+                del self.buffers[next(iter(self.buffers))]
+            height = max(panel.shape[0] for panel in panels)
+            frame = self.buffers[layout] = np.full((height, sum(panel.shape[1] for panel in panels), 3),
+                                                   255, np.uint8)
+        # Padding is never written to so it stays white, every frame is a single copy of each panel
+        x = 0
+        for panel in panels:
+            height, width, _ = panel.shape
+            np.copyto(frame[:height, x:x + width], panel)
+            x += width
+        return frame
 
 
 def combine_images(left, right):
-    left_height, left_width, _ = left.shape
-    right_height, right_width, _ = right.shape
-    combined_im = np.zeros([left_height, left_width + right_width, 3], np.uint8)
-    combined_im.fill(255)
-    combined_im[0:left_height, 0:left_width, :] = left[:, :, :]
-    combined_im[0:left_height, left_width:left_width + right_width, :] = right[:, :, :]
-    return combined_im
+    return Compositor().compose(left, right)
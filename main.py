@@ -1,14 +1,32 @@
 # Copyright (c) 2022, Jonathan Derrick
 # SPDX-License-Identifier: GPL-3.0-or-later
-import resorts
+import metrics
+import scheduler
+import server
+import sys
 import time
 from PIL import Image
 
 
 if __name__ == '__main__':
     # Runs every minute, avoiding drift
+    # Upcoming frames are prepared in the background, a frame that
+    # misses its slot is replaced by the previous one
+    # --headless serves frames over HTTP instead of showing them
+    headless = '--headless' in sys.argv
+    if headless:
+        frames = server.FrameServer()
+        frames.start()
+    s = scheduler.Scheduler()
     start_time = time.time()
-    while True:
-        im = resorts.get_next_resort_image()
-        Image.fromarray(im).show()
-        time.sleep(60 - ((time.time() - start_time) % 60))
+    try:
+        while True:
+            im = s.next_frame()
+            if headless:
+                frames.publish(s.resort, im)
+            else:
+                Image.fromarray(im).show()
+            metrics.export()
+            time.sleep(60 - ((time.time() - start_time) % 60))
+    finally:
+        s.shutdown()
@@ -0,0 +1,166 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import config
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from functools import wraps
+
+# Latency histogram buckets in seconds
+buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+# (name, labels) -> [per-bucket counts, sum, count]
+_histograms = {}
+_counters = {}
+_gauges = {}
+# Events waiting for the next export, oldest dropped if nothing exports them
+_events = deque(maxlen=10000)
+_disabled = nullcontext()
+
+
+def enabled():
+    return config.get().metrics.enabled
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _event(kind, name, value, labels):
+    _events.append({'time': time.time(), 'type': kind, 'metric': name, 'value': value, **labels})
+
+
+# Updates the metric an event is about, with _lock held
+def _apply(kind, name, value, labels):
+    key = _key(name, labels)
+    if kind == 'latency':
+        histogram = _histograms.setdefault(key, [[0] * len(buckets), 0., 0])
+        for i, bucket in enumerate(buckets):
+            if value <= bucket:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    elif kind == 'count':
+        _counters[key] = _counters.get(key, 0) + value
+    else:
+        _gauges[key] = value
+
+
+def _record(kind, name, value, labels):
+    if not enabled():
+        return
+    with _lock:
+        _apply(kind, name, value, labels)
+        _event(kind, name, value, labels)
+
+
+def observe(name, seconds, **labels):
+    _record('latency', name, seconds, labels)
+
+
+def count(name, value=1, **labels):
+    _record('count', name, value, labels)
+
+
+def gauge(name, value, **labels):
+    _record('gauge', name, value, labels)
+
+
+# Takes the pending events, for a worker process to hand them to the one that exports
+def drain():
+    with _lock:
+        events = list(_events)
+        _events.clear()
+    return events
+
+
+# Records events drained in another process as if they had happened here
+def merge(events):
+    with _lock:
+        for event in events:
+            labels = {key: value for key, value in event.items() if key not in ('time', 'type', 'metric', 'value')}
+            _apply(event['type'], event['metric'], event['value'], labels)
+            _events.append(event)
+
+
+class _Timer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+# Times the enclosed block, a no-op context when metrics are disabled
+def timer(name, **labels):
+    if not enabled():
+        return _disabled
+    return _Timer(name, labels)
+
+
+def timed(name):
+    def wrapper(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return timed_func
+    return wrapper
+
+
+def _series(name, labels, extra=()):
+    labels = ','.join(f'{key}="{value}"' for key, value in tuple(labels) + tuple(extra))
+    return f'snowcam_{name}{{{labels}}}' if labels else f'snowcam_{name}'
+
+
+def prometheus():
+    lines = []
+    with _lock:
+        for kind, suffix, values in (('counter', '_total', _counters), ('gauge', '', _gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f'# TYPE snowcam_{name}{suffix} {kind}')
+                lines += [f'{_series(name + suffix, labels)} {value}'
+                          for (n, labels), value in sorted(values.items()) if n == name]
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f'# TYPE snowcam_{name}_seconds histogram')
+            for (n, labels), (counts, total, samples) in sorted(_histograms.items()):
+                if n != name:
+                    continue
+                for bucket, bucket_count in zip(buckets, counts):
+                    lines.append(f'{_series(name + "_seconds_bucket", labels, (("le", bucket),))} {bucket_count}')
+                lines.append(f'{_series(name + "_seconds_bucket", labels, (("le", "+Inf"),))} {samples}')
+                lines.append(f'{_series(name + "_seconds_sum", labels)} {total}')
+                lines.append(f'{_series(name + "_seconds_count", labels)} {samples}')
+    return '\n'.join(lines) + '\n'
+
+
+# Appends pending events to the JSON lines log and rewrites the Prometheus textfile
+def export():
+    cfg = config.get().metrics
+    if not cfg.enabled:
+        return
+    events = drain()
+    if events:
+        # At most two logs' worth of events are kept on disk
+        try:
+            if os.path.getsize(cfg.jsonl) >= cfg.jsonl_max_bytes:
+                os.replace(cfg.jsonl, f'{cfg.jsonl}.1')
+        except FileNotFoundError:
+            pass
+        with open(cfg.jsonl, 'a') as f:
+            f.writelines(json.dumps(event) + '\n' for event in events)
+    # node_exporter may read at any time, never let it see a partial file
+    tmp = f'{cfg.textfile}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus())
+    os.replace(tmp, cfg.textfile)
@@ -0,0 +1,218 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import config
+import cv2
+import lib
+import metrics
+import numpy as np
+import os
+import server
+import signal
+import snowstakeimage
+import sys
+import time
+import weather
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+# Rendered 640x480 timecam frame, larger panels grow their block
+panel_bytes = 480 * 5 * 640 * 5 * 3
+# Seconds the parent waits past the workers' own timeouts before giving up on a job
+slack = 30
+
+
+def _init_worker():
+    # One resort per process, don't let OpenCV oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+def _timeout(signum, frame):
+    raise TimeoutError('timed out')
+
+
+# Retrieves, analyses and renders one resort in a worker process
+# The panel is written into the resort's shared memory block, only the small result is pickled back
+# along with the metrics recorded meanwhile, the parent merges and exports them
+# Workers run jobs on their main thread, so SIGALRM bounds each one and frees the worker on expiry
+def refresh(resort, block, size, timeout):
+    # Forked workers start out with a copy of the parent's pending events
+    metrics.drain()
+    start = time.perf_counter()
+    cpu = time.process_time()
+    signal.signal(signal.SIGALRM, _timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        s = snowstakeimage.get_detector(resort)(None).run()
+    except Exception as e:
+        return {'resort': resort, 'pid': os.getpid(), 'error': str(e) or type(e).__name__,
+                'seconds': time.perf_counter() - start, 'cpu': time.process_time() - cpu,
+                'events': metrics.drain()}
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+    result = {'resort': resort, 'pid': os.getpid(), 'inches': s.inches, 'rotation': s.rotation,
+              'time': s.time, 'shape': s.im.shape}
+    if s.im.nbytes <= size:
+        shm = shared_memory.SharedMemory(name=block)
+        np.copyto(np.ndarray(s.im.shape, np.uint8, shm.buf), s.im)
+        shm.close()
+    else:
+        # Doesn't fit, sent back pickled this once and the block is grown for the next cycle
+        result['im'] = s.im
+    result['seconds'] = time.perf_counter() - start
+    result['cpu'] = time.process_time() - cpu
+    result['events'] = metrics.drain()
+    return result
+
+
+# Refreshes every configured resort each timecam cycle across a process pool
+class Engine:
+    def __init__(self, workers=None, timeout=60):
+        self.workers = workers or os.cpu_count()
+        self.timeout = timeout
+        self.pool = self.new_pool()
+        # Resort -> shared memory block its panels are written to
+        self.blocks = {}
+        # Resort -> latest successful result, with 'im' a view of its block
+        self.results = {}
+
+    def block(self, resort, size=panel_bytes):
+        shm = self.blocks.get(resort)
+        if shm is None or shm.size < size:
+            if shm is not None:
+                self.results.pop(resort, None)
+                shm.close()
+                shm.unlink()
+            shm = self.blocks[resort] = shared_memory.SharedMemory(create=True, size=size)
+        return shm
+
+    def new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    # A dead worker breaks the whole pool and one stuck in C code never frees its slot, start over
+    def restart(self):
+        for process in list((self.pool._processes or {}).values()):
+            process.kill()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = self.new_pool()
+
+    def submit(self, resort):
+        shm = self.block(resort)
+        try:
+            return self.pool.submit(refresh, resort, shm.name, shm.size, self.timeout)
+        except BrokenProcessPool:
+            self.restart()
+            return self.pool.submit(refresh, resort, shm.name, shm.size, self.timeout)
+
+    # Runs one cycle, calling done(result) as each resort finishes, and returns the cycle report
+    def cycle(self, done=None):
+        start = time.perf_counter()
+        futures = {}
+        for resort in config.reload().resorts:
+            futures[self.submit(resort)] = resort
+
+        busy = defaultdict(float)
+        errors = {}
+        # Jobs queue behind each other, so each round of workers gets its own timeout
+        rounds = -(-len(futures) // self.workers)
+        broken = False
+        try:
+            for future in as_completed(futures, timeout=rounds * self.timeout + slack):
+                resort = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # A worker died, taking the pool and every resort still in it down too
+                    broken |= isinstance(e, BrokenProcessPool)
+                    result = {'resort': resort, 'error': str(e) or type(e).__name__}
+                metrics.merge(result.pop('events', ()))
+                if 'pid' in result:
+                    busy[result['pid']] += result['cpu']
+                if 'error' in result:
+                    errors[resort] = result['error']
+                    metrics.count('refresh', resort=resort, result='error')
+                    continue
+                metrics.count('refresh', resort=resort, result='ok')
+                metrics.observe('refresh_resort', result['seconds'], resort=resort)
+                if 'im' in result:
+                    self.block(resort, result['im'].nbytes)
+                else:
+                    result['im'] = np.ndarray(result['shape'], np.uint8, self.blocks[resort].buf)
+                self.results[resort] = result
+                if done:
+                    done(result)
+        except TimeoutError:
+            # Stuck where SIGALRM can't reach it, the worker is killed with the pool
+            broken = True
+            for future, resort in futures.items():
+                if not future.done():
+                    errors[resort] = 'timed out'
+                    metrics.count('refresh', resort=resort, result='error')
+        if broken:
+            self.restart()
+
+        elapsed = time.perf_counter() - start
+        report = {
+            'resorts': len(futures),
+            'failed': errors,
+            'seconds': elapsed,
+            'resorts_per_minute': (len(futures) - len(errors)) / elapsed * 60,
+            # CPU time of each worker process over the cycle, about the load on the core it ran on
+            'utilization': {pid: cpu / elapsed for pid, cpu in sorted(busy.items())},
+        }
+        metrics.gauge('refresh_resorts_per_minute', report['resorts_per_minute'])
+        metrics.gauge('refresh_utilization', sum(report['utilization'].values()) / self.workers)
+        return report
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        # Views of the blocks have to go before the blocks can be closed
+        self.results.clear()
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks.clear()
+
+
+def print_report(report):
+    print(f'{report["resorts"]} resorts in {report["seconds"]:.1f}s, '
+          f'{report["resorts_per_minute"]:.1f} resorts/minute')
+    for resort, error in report['failed'].items():
+        print(f'  {resort} failed: {error}', file=sys.stderr)
+    for pid, utilization in report['utilization'].items():
+        print(f'  worker {pid}: {utilization:.0%} busy')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh every configured resort each timecam cycle')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('-t', '--timeout', type=float, default=60, help='seconds allowed per resort')
+    parser.add_argument('--once', action='store_true', help='run a single cycle and exit')
+    parser.add_argument('--headless', action='store_true', help='serve every resort over HTTP')
+    args = parser.parse_args()
+
+    done = None
+    if args.headless:
+        frames = server.FrameServer()
+        frames.start()
+        compositor = lib.Compositor()
+
+        def done(result):
+            resort = result['resort']
+            frames.publish(resort, compositor.compose(weather.get_weather_image(resort), result['im']))
+
+    engine = Engine(args.workers, args.timeout)
+    # Runs every 5 minutes, avoiding drift
+    start_time = time.time()
+    try:
+        while True:
+            print_report(engine.cycle(done))
+            metrics.export()
+            if args.once:
+                break
+            time.sleep(300 - ((time.time() - start_time) % 300))
+    finally:
+        engine.shutdown()
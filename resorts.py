@@ -1,44 +1,46 @@
 # Copyright (c) 2022, Jonathan Derrick
 # SPDX-License-Identifier: GPL-3.0-or-later
+import config
 import lib
+import metrics
+import snowstakeimage
 import weather
-import json
-from vail import vail
-from breckenridge import breckenridge
 from PIL import Image
 
 
-cfg = None
-try:
-    cfg = json.load(open('config.json'))
-except Exception as e:
-    print(e)
-    exit(1)
-
-
-resorts = list(cfg['resorts'])
 resort_index = 0
 
 
 def get_snow_image(city):
-    try:
-        return eval(city).get_image()
-    except Exception as e:
-        raise e
+    with metrics.timer('snow_image', resort=city):
+        return snowstakeimage.get_detector(city)(None).run().im
 
 
-def get_next_resort_image():
+def get_resort_image(resort):
+    with metrics.timer('resort_image', resort=resort):
+        snow_im = get_snow_image(resort)
+        weather_im = weather.get_weather_image(resort)
+        return lib.combine_images(left=weather_im, right=snow_im)
+
+
+# Round-robin over the configured resorts
+def next_resort():
     global resort_index
+    # Pick up config.json edits between cycles
+    resorts = list(config.reload().resorts)
+    resort_index %= len(resorts)
     resort = resorts[resort_index]
-    snow_im = get_snow_image(resort)
-    weather_im = weather.get_weather_image(resort)
-    combined_im = lib.combine_images(left=weather_im, right=snow_im)
     resort_index += 1
     if resort_index == len(resorts):
         resort_index = 0
-    return combined_im
+    return resort
+
+
+def get_next_resort_image():
+    return get_resort_image(next_resort())
 
 
 if __name__ == '__main__':
     im = get_next_resort_image()
+    metrics.export()
     Image.fromarray(im).show()
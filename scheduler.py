@@ -0,0 +1,58 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import lib
+import resorts
+import weather
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# Fetches and processes upcoming resorts on a thread pool ahead of their display slot
+# The snow and weather panels of a resort are retrieved concurrently
+# and only composed once the frame is handed off
+class Scheduler:
+    def __init__(self, ahead=2, workers=4):
+        self.ahead = ahead
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.frame = None
+        self.compositor = lib.Compositor()
+        # Resort shown in frame
+        self.resort = None
+
+    def fill(self):
+        while len(self.pending) < self.ahead:
+            resort = resorts.next_resort()
+            # A resort is never in flight twice, its panels, frames and calibration are shared
+            if any(resort == pending[0] for pending in self.pending):
+                break
+            self.pending.append((resort,
+                                 self.pool.submit(resorts.get_snow_image, resort),
+                                 self.pool.submit(weather.get_weather_image, resort)))
+
+    # Returns the next finished frame, only the very first frame is waited for
+    # If it isn't ready within timeout the previous frame is returned again and it stays queued
+    def next_frame(self, timeout=0):
+        self.fill()
+        resort, snow, weather_im = self.pending[0]
+        if self.frame is not None:
+            _, not_done = wait((snow, weather_im), timeout)
+            if not_done:
+                print(f'{resort} not ready, keeping previous frame')
+                return self.frame
+
+        # Composed before refilling, the refill can redraw this resort's weather panel in place
+        self.pending.popleft()
+        try:
+            self.frame = self.compositor.compose(weather_im.result(), snow.result())
+            self.resort = resort
+        except Exception as e:
+            if self.frame is None:
+                raise e
+            print(e)
+        finally:
+            self.fill()
+        return self.frame
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
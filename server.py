@@ -0,0 +1,109 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import config
+import cv2
+import hashlib
+import metrics
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+content_types = {'jpg': 'image/jpeg', 'png': 'image/png'}
+# Longest a client may long-poll for a new frame, in seconds
+max_wait = 60
+
+
+# Content hash of a frame, stable across restarts and equal for identical frames
+def etag(im):
+    return f'"{hashlib.blake2b(im, digest_size=16).hexdigest()}"'
+
+
+# One produced frame, already encoded in every configured format
+class Frame:
+    def __init__(self, im, etag, formats):
+        self.etag = etag
+        self.formats = formats
+        bgr = cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
+        self.data = {}
+        for fmt in formats:
+            with metrics.timer('encode', format=fmt):
+                _, data = cv2.imencode(f'.{fmt}', bgr)
+            self.data[fmt] = data.tobytes()
+
+
+# Latest frame of every resort, plus 'rotation' for whatever was displayed last
+class FrameServer:
+    def __init__(self):
+        self.frames = {}
+        self.condition = threading.Condition()
+
+    # A frame identical to one already published keeps its ETag and encoding
+    def publish(self, resort, im):
+        formats = config.get().server.formats
+        tag = etag(im)
+        with self.condition:
+            frame = next((frame for frame in self.frames.values()
+                          if frame.etag == tag and frame.formats == formats), None)
+        if frame is None:
+            frame = Frame(im, tag, formats)
+        with self.condition:
+            if self.frames.get(resort) is frame and self.frames.get('rotation') is frame:
+                return
+            self.frames[resort] = frame
+            self.frames['rotation'] = frame
+            self.condition.notify_all()
+
+    # Latest frame of name, waiting up to wait seconds for one that doesn't carry etag
+    def get(self, name, etag=None, wait=0):
+        with self.condition:
+            if wait:
+                self.condition.wait_for(lambda: name in self.frames and self.frames[name].etag != etag, wait)
+            return self.frames.get(name)
+
+    def start(self):
+        cfg = config.get().server
+        httpd = ThreadingHTTPServer((cfg.host, cfg.port), _handler(self))
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+def _handler(frames):
+    # GET /<resort or rotation>.<jpg|png>[?wait=seconds]
+    # With If-None-Match and wait the request is held until a newer frame is published
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            name, _, fmt = url.path.strip('/').rpartition('.')
+            if fmt not in content_types:
+                self.send_error(404)
+                return
+            etag = self.headers.get('If-None-Match')
+            try:
+                wait = min(float(parse_qs(url.query).get('wait', ['0'])[0]), max_wait) if etag else 0
+            except ValueError:
+                self.send_error(400)
+                return
+
+            frame = frames.get(name, etag, wait)
+            if frame is None or fmt not in frame.data:
+                self.send_error(404)
+                return
+            metrics.count('server_requests', status=304 if frame.etag == etag else 200)
+            if frame.etag == etag:
+                self.send_response(304)
+                self.send_header('ETag', frame.etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_types[fmt])
+            self.send_header('Content-Length', str(len(frame.data[fmt])))
+            self.send_header('ETag', frame.etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(frame.data[fmt])
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
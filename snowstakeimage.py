@@ -1,73 +1,184 @@
 # Copyright (c) 2022, Jonathan Derrick
 # SPDX-License-Identifier: GPL-3.0-or-later
+import calibration
+import config
+import fetch
+import framestore
+import history
 import lib
+import metrics
 import cv2
-import json
+import hashlib
+import importlib
 import math
 import numpy as np
-import requests
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from PIL import Image
 
 
+# Resort name -> SnowStakeImage subclass, filled in by @register as resort modules are imported
+detectors = {}
+
+
+def register(resort, source='timecam'):
+    def wrapper(cls):
+        cls.source = source
+        detectors[resort] = cls
+        return cls
+    return wrapper
+
+
+# Resort -> the last frame run() processed and its results, see SnowStakeImage.run
+processed = {}
+
+
+# Imports the resort's module from config.json the first time it is needed
+def get_detector(resort):
+    if resort not in detectors:
+        module = config.get().resorts[resort].module
+        importlib.import_module(module)
+        if resort not in detectors:
+            raise ValueError(f'{module} does not register a detector for {resort}')
+    return detectors[resort]
+
+
 class SnowStakeImage:
-    def __init__(self, im, resort):
-        try:
-            self.cfg = json.load(open('config.json'))['resorts'][resort]
-            self.resort = resort
-        except Exception as e:
-            print(e)
-            exit(1)
+    # Where frames are retrieved from, dispatched to retrieve_<source>
+    source = 'timecam'
+    # Timecam frames are 640x480 but everything is rendered (and configured) at 5x
+    render_scale = 5
+    # Scale detection runs at, 1 is the native camera resolution
+    analysis_scale = 1
+    # Largest per-cell difference of the frame thumbnails for a frame to count as a near-duplicate
+    duplicate_threshold = 8
+
+    # time is when im was taken, retrieved frames carry their own
+    def __init__(self, im, resort, analysis_scale=None, time=None):
+        self.cfg = config.get().resorts[resort]
+        self.resort = resort
+        self.time = datetime.now() if time is None else time
 
         self.im = im
         if self.im is None:
-            self.im = self.retrieve_image()
-        self.im = np.array(self.im)
-        self.im = cv2.resize(self.im, None, fx=5, fy=5)
+            with metrics.timer('retrieve', resort=resort):
+                self.im = self.retrieve_image()
+        self.im = np.asarray(self.im)
+        # Identifies the frame for run(): exact content and a 8x8 cell grayscale thumbnail
+        self.digest = hashlib.blake2b(np.ascontiguousarray(self.im)).digest()
+        gray = cv2.cvtColor(self.im, cv2.COLOR_RGB2GRAY)
+        self.thumbnail = cv2.resize(gray, (gray.shape[1] // 8, gray.shape[0] // 8),
+                                    interpolation=cv2.INTER_AREA).astype(np.int16)
+        # Analysis runs at analysis_scale, upscale() brings the frame up to render_scale once detection is done
+        if analysis_scale is not None:
+            self.analysis_scale = analysis_scale
+        if self.analysis_scale != 1:
+            self.im = cv2.resize(self.im, None, fx=self.analysis_scale, fy=self.analysis_scale)
+        # Unrotated analysis frame, the render warp starts from this rather than the rotated copy
+        self.frame = self.im
         self.rotation = 0
         self.inches = 0
-        self.time = datetime.now()
-        self.box_height = self.cfg['box']['height']
-        self.box_width = self.cfg['box']['width']
+        self.box_height = self.cfg.box.height * self.analysis_scale / self.render_scale
+        self.box_width = self.cfg.box.width * self.analysis_scale / self.render_scale
         self.box_ypos = 0
         self.box_xpos = 0
         self.boxes = {}
+        # Text is queued by draw_snowline/attach_*_text and rendered in one pass by draw_text
+        self.text = lib.TextLayer()
 
     def retrieve_image(self):
-        if self.resort == 'breckenridge' or self.resort == 'vail':
-            url_type = 'timecam'
-
-        if url_type == 'timecam':
-            now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
-            # Round down to nearest 5 minutes and subtract another 10 minutes for upload cushion
-            self.time = now - timedelta(minutes=now.minute % 5) - timedelta(minutes=10)
-
-            url = self.cfg['url']
-            hour = self.time.strftime('%Y_%m_%d_%H')
-            minute = hour + self.time.strftime('_%M')
-            url = url.replace('##HOUR##', hour)
-            url = url.replace('##MINUTE##', minute)
-            r = requests.get(url, stream=True)
-            if r.status_code == 200:
-                r.raw.decode_content = True
-                return Image.open(r.raw)
-            raise requests.RequestException(f'Status: {r.status_code}')
-        else:
-            raise ValueError(f'unsupported resort {self.resort}')
+        retrieve = getattr(self, f'retrieve_{self.source}', None)
+        if retrieve is None:
+            raise ValueError(f'unsupported source {self.source} for resort {self.resort}')
+        return retrieve()
+
+    def retrieve_timecam(self):
+        # In replay mode the network isn't touched at all
+        store = framestore.store()
+        if store.cfg.replay:
+            latest = store.latest(self.resort, datetime.now(timezone.utc))
+            if latest is None:
+                raise FileNotFoundError(f'no stored frames for {self.resort} in {store.root}')
+            self.time, path = latest
+            with open(path, 'rb') as f:
+                return fetch.decode_image(f.read())
+
+        self.time, data = framestore.newest(self.resort)
+        metrics.gauge('frame_age', (datetime.now(timezone.utc) - self.time).total_seconds() / 60, resort=self.resort)
+        return fetch.decode_image(data)
+
+    # Converts a render-scale (5x) coordinate or length to the current analysis scale
+    def scaled(self, value):
+        return int(round(value * self.analysis_scale / self.render_scale))
+
+    # Converts a render-scale (5x) pixel count to the current analysis scale
+    def scaled_area(self, count):
+        return count * math.pow(self.analysis_scale / self.render_scale, 2)
+
+    # Rectangular structuring element of a render-scale size, kept odd so it stays centered
+    def kernel(self, size):
+        size = max(1, self.scaled(size)) | 1
+        return cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+
+    # Region of the analysed frame given in render-scale (5x) coordinates, resampled to render scale
+    # Sampled like the same crop of a full-frame resize, without resizing the rest of the frame
+    def render_crop(self, ypos, xpos, height, width):
+        factor = self.render_scale / self.analysis_scale
+        if factor == 1:
+            return self.im[ypos:ypos + height, xpos:xpos + width]
+        matrix = np.float64([[1 / factor, 0, (xpos + .5) / factor - .5],
+                             [0, 1 / factor, (ypos + .5) / factor - .5]])
+        return cv2.warpAffine(self.im, matrix, (width, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_REPLICATE)
 
     def create_box(self, n):
-        return ((self.box_xpos, self.box_ypos + self.box_height * n),
-                (self.box_xpos + self.box_width, self.box_ypos + self.box_height * (n + 1)))
+        return ((self.box_xpos, int(round(self.box_ypos + self.box_height * n))),
+                (int(round(self.box_xpos + self.box_width)), int(round(self.box_ypos + self.box_height * (n + 1)))))
 
     def create_boxes(self):
-        for i in range(0, self.cfg['inches'] + 1):
-            self.boxes[str(self.cfg['inches'] - i)] = self.create_box(i)
+        for i in range(0, self.cfg.inches + 1):
+            self.boxes[str(self.cfg.inches - i)] = self.create_box(i)
+
+    # Boxes in inch order and the (x0, y0, x1, y1) frame region covering all of them
+    def box_region(self):
+        boxes = [self.boxes[str(i)] for i in range(len(self.boxes))]
+        height, width, _ = self.im.shape
+        x0 = min(max(0, min(box[0][0] for box in boxes)), width)
+        y0 = min(max(0, min(box[0][1] for box in boxes)), height)
+        x1 = max(x0, min(width, max(box[1][0] for box in boxes)))
+        y1 = max(y0, min(height, max(box[1][1] for box in boxes)))
+        return boxes, (x0, y0, x1, y1)
 
     def rotate(self, rotation=0):
         if rotation != 0:
-            rows, cols, _ = self.im.shape
+            rows, cols, _ = self.frame.shape
             matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), rotation, 1)
-            self.im = cv2.warpAffine(self.im, matrix, (cols, rows))
+            self.im = cv2.warpAffine(self.frame, matrix, (cols, rows))
+
+    # Smallest zoom that keeps the black rotation borders out of a same-sized crop
+    # The crop rotated back by -rotation has to fit inside the original frame
+    @staticmethod
+    def rotation_zoom(rows, cols, rotation):
+        theta = math.radians(abs(rotation))
+        return max(math.cos(theta) + rows / cols * math.sin(theta),
+                   math.cos(theta) + cols / rows * math.sin(theta))
+
+    # Rotate, zoom past the rotation borders and upscale to render resolution in a single warp
+    # The box geometry is carried along into render coordinates
+    def upscale(self):
+        rows, cols, _ = self.frame.shape
+        zoom = self.rotation_zoom(rows, cols, self.rotation)
+        factor = self.render_scale / self.analysis_scale
+        if factor != 1 or zoom != 1:
+            matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), self.rotation, zoom * factor)
+            matrix[:, 2] += (cols * factor - cols) / 2, (rows * factor - rows) / 2
+            self.im = cv2.warpAffine(self.frame, matrix, (int(cols * factor), int(rows * factor)))
+        self.analysis_scale = self.render_scale
+        self.box_xpos = int(round(cols * factor / 2 + (self.box_xpos - cols / 2) * zoom * factor))
+        self.box_ypos = int(round(rows * factor / 2 + (self.box_ypos - rows / 2) * zoom * factor))
+        self.box_height = self.cfg.box.height * zoom
+        self.box_width = self.cfg.box.width * zoom
+        if self.boxes:
+            self.create_boxes()
 
     def draw_boxes(self):
         for i in self.boxes:
@@ -77,51 +188,138 @@ class SnowStakeImage:
         box = self.boxes[str(self.inches)]
         spos_x = box[0][0]
         epos_x = spos_x - 300
-        spos_y = box[0][1] + self.box_height
+        spos_y = box[1][1]
         epos_y = spos_y - 5
         cv2.rectangle(self.im, (spos_x, spos_y), (epos_x, epos_y), (0, 0, 0), -1)
-        self.im = lib.add_text(self.im, xy=(epos_x, epos_y - 10), text=f'{self.inches}"', align='left', anchor='ls',
-                               fill='white', stroke_fill='black', stroke_width=10,
-                               font='LiberationSerif-Regular.ttf', font_size=200)
+        self.text.add_text(xy=(epos_x, epos_y - 10), text=f'{self.inches}"', align='left', anchor='ls',
+                           fill='white', stroke_fill='black', stroke_width=10,
+                           font='LiberationSerif-Regular.ttf', font_size=200)
 
     def attach_datetime_text(self, ypos, xpos, align, anchor, font_size):
-        self.im = lib.add_text(self.im, xy=(xpos, ypos), text=self.time.strftime('%b %d %Y\n%-I:%M%p'),
-                               align=align, anchor=anchor,
-                               fill='white', stroke_fill='black', stroke_width=10,
-                               font='LiberationSerif-Regular.ttf', font_size=font_size)
+        self.text.add_text(xy=(xpos, ypos), text=self.time.astimezone().strftime('%b %d %Y\n%-I:%M%p'),
+                           align=align, anchor=anchor,
+                           fill='white', stroke_fill='black', stroke_width=10,
+                           font='LiberationSerif-Regular.ttf', font_size=font_size)
 
     def attach_inches_text(self, ypos, xpos, text, align, anchor, font_size):
-        self.im = lib.add_text(self.im, xy=(xpos, ypos), text=text, align=align, anchor=anchor,
-                               fill='white', stroke_fill='black', stroke_width=10,
-                               font='LiberationSerif-Regular.ttf', font_size=font_size)
-
-    # Iteratively resize until the corners are non-black
-    # Then use the iteration count to resize the original
-    # Clunky but still pretty fast
-    def resize_and_crop(self):
-        im = cv2.cvtColor(self.im, cv2.COLOR_RGB2GRAY)
-        height, width = im.shape
-        iterations = 0
-        while im[0][0] == 0 or im[height - 1][0] == 0 or \
-                im[0][width - 1] == 0 or im[height - 1][width - 1] == 0:
-            im = cv2.resize(im, None, fx=1.01, fy=1.01)
-            new_height, new_width = im.shape
-            y_offset = int((new_height - height) / 2)
-            x_offset = int((new_width - width) / 2)
-            im = im[y_offset:y_offset + height, x_offset:x_offset + width]
-            iterations += 1
-        scale = math.pow(1.01, iterations)
-        self.im = cv2.resize(self.im, None, fx=scale, fy=scale)
-        new_height, new_width, _ = self.im.shape
-        y_offset = int((new_height - height) / 2)
-        x_offset = int((new_width - width) / 2)
-        self.im = self.im[y_offset:y_offset + height, x_offset:x_offset + width]
+        self.text.add_text(xy=(xpos, ypos), text=text, align=align, anchor=anchor,
+                           fill='white', stroke_fill='black', stroke_width=10,
+                           font='LiberationSerif-Regular.ttf', font_size=font_size)
+
+    def draw_text(self):
+        self.im = self.text.flush(self.im)
 
     def show(self):
         Image.fromarray(self.im).show()
 
+    # Reuses the saved calibration while the stake is still where and as straight as it was left
+    # Otherwise, or once the calibration is too old, runs auto_adjust and saves the result
+    def calibrate(self):
+        saved = calibration.load(self.resort)
+        if saved is not None and calibration.is_current(saved, self.analysis_scale):
+            rotation = self.measure_rotation()
+            self.rotation = float(saved['rotation'])
+            self.rotate(self.rotation)
+            moved = calibration.drift(self, saved, rotation)
+            if moved is not None:
+                self.box_xpos = int(saved['box_xpos']) + moved[0]
+                self.box_ypos = int(saved['box_ypos']) + moved[1]
+                metrics.count('calibration', resort=self.resort, result='reused')
+                return
+            self.im = self.frame
+            self.rotation = 0
+        metrics.count('calibration', resort=self.resort, result='full')
+        with metrics.timer('auto_adjust', resort=self.resort):
+            self.auto_adjust()
+        calibration.save(self.resort, calibration.create(self))
+
+    # Calibration and detection only, nothing is rendered
+    # cached=False always runs a full auto_adjust and leaves the saved calibration alone
+    def analyze(self, cached=True):
+        with metrics.timer('calibrate', resort=self.resort):
+            if cached:
+                self.calibrate()
+            else:
+                self.auto_adjust()
+        self.create_boxes()
+        with metrics.timer('detect_snow', resort=self.resort):
+            found = self.detect_snow()
+        metrics.count('detections', resort=self.resort, result='none' if found is None else 'found')
+        metrics.gauge('inches', self.inches, resort=self.resort)
+        metrics.gauge('rotation', self.rotation, resort=self.resort)
+        return self
+
+    # Whether the frame looks like the one thumbnail was taken from apart from compression noise
+    def near_duplicate(self, thumbnail):
+        return (self.thumbnail.shape == thumbnail.shape and
+                np.abs(self.thumbnail - thumbnail).max() <= self.duplicate_threshold)
+
+    # Detection followed by the rendered overlay
+    # Timecam frames are re-requested until the next one is uploaded, and stale frames get served
+    # again under new times. A frame identical to the previous one reuses its whole result,
+    # a near-duplicate of the last analysed frame reuses its detection and is only rendered again
+    # Near-duplicates are never chained, so a slow change still gets analysed once it adds up
+    # cached is passed on to analyze()
+    def run(self, cached=True):
+        previous = processed.get(self.resort)
+        # Results are only comparable between frames processed the same way
+        setup = (type(self), self.cfg, self.analysis_scale)
+        if previous is not None and previous['setup'] != setup:
+            previous = None
+
+        if previous and previous['s'].digest == self.digest:
+            metrics.count('frame_change', resort=self.resort, result='unchanged')
+            vars(self).update(vars(previous['s']))
+            return self
+
+        if previous and self.near_duplicate(previous['thumbnail']):
+            metrics.count('frame_change', resort=self.resort, result='duplicate')
+            self.rotation, self.inches, self.box_xpos, self.box_ypos = previous['detection']
+            self.rotate(self.rotation)
+            self.create_boxes()
+            analysed = previous
+        else:
+            metrics.count('frame_change', resort=self.resort, result='new')
+            self.analyze(cached)
+            history.get(self.resort).append(self.time, self.inches, self.rotation, self.box_xpos, self.box_ypos)
+            analysed = {'detection': (self.rotation, self.inches, self.box_xpos, self.box_ypos),
+                        'thumbnail': self.thumbnail}
+
+        self.smooth()
+        self.render()
+        # The rendered frame is handed out again on unchanged frames so it must stay untouched
+        self.im.setflags(write=False)
+        processed[self.resort] = {'setup': setup, 'detection': analysed['detection'],
+                                  'thumbnail': analysed['thumbnail'], 's': self}
+        return self
+
+    # Displays the reading smoothed over the recent history rather than this frame's alone
+    def smooth(self):
+        reading = history.get(self.resort).smoothed(self.time)
+        if reading is not None:
+            self.inches = min(int(round(reading)), self.cfg.inches)
+            metrics.gauge('smoothed_inches', reading, resort=self.resort)
+
+    # Overlay of the analysed frame at render resolution
+    def render(self):
+        with metrics.timer('upscale', resort=self.resort):
+            self.upscale()
+        # self.draw_boxes()
+        self.draw_snowline()
+        self.attach_datetime_text(10, 50, 'left', 'la', 200)
+        self.attach_resort_text()
+        self.draw_text()
+        return self
+
+    def attach_resort_text(self):
+        raise NotImplementedError('attach_resort_text must be implemented by subclass')
+
     def auto_adjust(self):
-        raise NotImplemented('auto_adjust must be implemented by subclass')
+        raise NotImplementedError('auto_adjust must be implemented by subclass')
+
+    # Rotation of the stake in the frame as it stands, measured like auto_adjust does
+    def measure_rotation(self):
+        raise NotImplementedError('measure_rotation must be implemented by subclass')
 
     def detect_snow(self):
-        raise NotImplemented('detect_snow must be implemented by subclass')
+        raise NotImplementedError('detect_snow must be implemented by subclass')
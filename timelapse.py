@@ -0,0 +1,106 @@
+# Copyright (c) 2022, Jonathan Derrick
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import backfill
+import cv2
+import fetch
+import os
+import queue
+import snowstakeimage
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Decodes, analyses and renders one frame, scaled down to width
+# Frames are calibrated individually and kept out of the live calibration, history and frame reuse
+def render(task, width):
+    resort, frame_time, _ = task
+    try:
+        s = snowstakeimage.get_detector(resort)(fetch.decode_image(backfill.load(task)), time=frame_time)
+        s.analyze(cached=False)
+        s.render()
+    except Exception as e:
+        print(f'{resort} {frame_time.isoformat()}: {e}', file=sys.stderr)
+        return None
+    height = int(round(s.im.shape[0] * width / s.im.shape[1])) & ~1
+    im = cv2.resize(s.im, (width, height), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
+
+
+# Rendered frames in time order, at most ahead of them in flight at once
+def frames(tasks, width, workers, ahead):
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for task in tasks:
+            pending.append(pool.submit(render, task, width))
+            if len(pending) >= ahead:
+                im = pending.popleft().result()
+                if im is not None:
+                    yield im
+        while pending:
+            im = pending.popleft().result()
+            if im is not None:
+                yield im
+
+
+# Writes frames to an MP4 on its own thread, fed through a queue of at most ahead frames
+def encode(frames, output, fps, ahead):
+    ready = queue.Queue(maxsize=ahead)
+    count = 0
+    error = None
+
+    def writer():
+        nonlocal count, error
+        video = None
+        # After a failure the queue is still drained so the producer never blocks on it
+        while (im := ready.get()) is not None:
+            if error:
+                continue
+            try:
+                if video is None:
+                    video = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                            (im.shape[1], im.shape[0]))
+                    if not video.isOpened():
+                        raise ValueError(f'unable to write {output}')
+                video.write(im)
+                count += 1
+            except Exception as e:
+                error = e
+        if video is not None:
+            video.release()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for im in frames:
+            ready.put(im)
+    finally:
+        ready.put(None)
+        thread.join()
+    if error:
+        raise error
+    return count
+
+
+def timelapse(resort, start, end, output, directory=None, fps=12, width=1280, workers=None):
+    workers = workers or os.cpu_count()
+    ahead = 2 * workers
+    return encode(frames(backfill.tasks(resort, start, end, directory), width, workers, ahead), output, fps, ahead)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a range of timecam frames into an MP4 timelapse')
+    parser.add_argument('resort')
+    parser.add_argument('start', type=backfill.parse_time, help='UTC start, e.g. 2022-12-14 or 2022-12-14T06:00')
+    parser.add_argument('end', type=backfill.parse_time, help='UTC end, exclusive')
+    parser.add_argument('-o', '--output', help='MP4 file, defaults to <resort>.mp4')
+    parser.add_argument('-d', '--directory', help='read frames from this directory instead of timecam')
+    parser.add_argument('--fps', type=float, default=12)
+    parser.add_argument('--width', type=int, default=1280, help='output width, height follows the frames')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    count = timelapse(args.resort, args.start, args.end, args.output or f'{args.resort}.mp4',
+                      directory=args.directory, fps=args.fps, width=args.width, workers=args.workers)
+    print(f'{count} frames written')
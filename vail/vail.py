@@ -1,67 +1,81 @@
 # Copyright (c) 2022, Jonathan Derrick
 # SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import backfill
+import framestore
 import lib
-from snowstakeimage import SnowStakeImage
+import server
+from snowstakeimage import SnowStakeImage, register
 import cv2
 import math
+import sys
 import time
 import numpy as np
+from datetime import datetime, timedelta, timezone
 from os.path import join
 from PIL import Image
 from statistics import mean
 
 
+@register('vail')
 class Vail(SnowStakeImage):
-    def __init__(self, im):
-        super().__init__(im, 'vail')
-
-    # Vail has a white image at the top of the snow stake
-    # And most of the rest of the stake is blue
-    def auto_adjust(self):
-        ypos = 200
-        xpos = 1100
-        height = 1000
-        width = 500
-
-        crop_im = self.im[ypos:ypos + height, xpos:xpos + width]
+    # Render-scale (ypos, xpos, height, width) of the crop the stake's left edge is scanned in
+    edge_crop = (200, 1100, 1000, 500)
+
+    def __init__(self, im, analysis_scale=None, time=None):
+        super().__init__(im, 'vail', analysis_scale, time)
+
+    # Left edge of the stake as (xval, rotation), xval in render-scale pixels from the crop's left
+    def stake_edge(self):
+        # The edge is scanned on a render-scale crop whatever the analysis scale
+        # Pairwise angles between rows a stride apart are too coarse on smaller frames,
+        # one pixel is about 4 degrees per sample at native resolution
+        ypos, xpos, height, width = self.edge_crop
+        crop_im = self.render_crop(ypos, xpos, height, width)
         crop_im = cv2.cvtColor(crop_im, cv2.COLOR_RGB2GRAY)
         th, im_crop = cv2.threshold(crop_im, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
 
         stride = int(height / 12) - 1
-        dist = []
-        for y in range(0, height, stride):
-            for x in range(0, width):
-                # This is very clearly Binary thresholded to black-and-white
-                # Why does it still require a grayscale value?
-                if crop_im[y][x] > 100:
-                    dist.append((y, x))
-                    break
-        xval = int(mean(lib.reject_outliers([x[1] for x in dist])))
-        self.box_xpos = xval + xpos + 5
+        rows = np.arange(0, height, stride)
+        # This is very clearly Binary thresholded to black-and-white
+        # Why does it still require a grayscale value?
+        xs = lib.first_hits(crop_im[rows] > 100)
+        dist = [(y, x) for y, x in zip(rows.tolist(), xs.tolist()) if x >= 0]
+        xval = mean(lib.reject_outliers([x[1] for x in dist]))
 
         # Trig: tan N = opposite / adjacent
         rotations = []
         for i in range(0, len(dist) - 1):
             oa = (dist[i + 1][1] - dist[i][1]) / (dist[i + 1][0] - dist[i][0])
             rotations.append(math.atan(oa) * 180 / math.pi)
-        self.rotation = -mean(lib.reject_outliers(rotations))
+        return xval, -mean(lib.reject_outliers(rotations))
+
+    def measure_rotation(self):
+        return self.stake_edge()[1]
+
+    # Vail has a white image at the top of the snow stake
+    # And most of the rest of the stake is blue
+    # Positions are in render-scale (5x) pixels and scaled to the analysed frame
+    def auto_adjust(self):
+        xval, self.rotation = self.stake_edge()
+        self.box_xpos = self.scaled(int(xval) + self.edge_crop[1] + 5)
+        xval = self.scaled(xval)
         self.rotate(self.rotation)
 
         # Now determine x/y adjust
-        ypos = 200
-        xpos = self.box_xpos + 10
-        height = 800
-        width = 500 - xval
+        ypos = self.scaled(200)
+        xpos = self.box_xpos + self.scaled(10)
+        height = self.scaled(800)
+        width = self.scaled(500) - xval
 
         im = cv2.cvtColor(self.im, cv2.COLOR_RGB2HSV)
         crop_im = im[ypos:ypos + height, xpos:xpos + width]
         lower_pink = np.array([100, 0, 0])
         upper_pink = np.array([180, 255, 255])
         mask = cv2.inRange(crop_im, lower_pink, upper_pink)
-        for y in range(0, height):
-            if mask[y][0] == 255:
-                self.box_ypos = y + ypos
-                break
+        y = lib.first_hit(mask[:, 0] == 255)
+        if y >= 0:
+            self.box_ypos = y + ypos
 
     def detect_snow(self):
         # Below 6", need to check snow stake consistency
@@ -74,33 +88,30 @@ class Vail(SnowStakeImage):
         # 6" and above, stake is blue and image can be compared against blue
         lower_blue = np.array([90, 127, 127])
         upper_blue = np.array([130, 255, 255])
-        for i in range(len(self.boxes)):
-            (spos, epos) = (self.boxes[str(i)][0], self.boxes[str(i)][1])
-            box = self.im[spos[1]:epos[1], spos[0]:epos[0]]
-            hsv = cv2.cvtColor(box, cv2.COLOR_RGB2HSV)
-
-            # Below 6", check count of hsv pink pixels
-            if int(i) < 6:
-                mask = cv2.inRange(hsv, lower_pink, upper_pink)
-                if np.count_nonzero(mask) > 1000:
-                    self.inches = i
-                    return i
-
-            # 6" and above, check count of im blue pixels
-            elif int(i) >= 6:
-                mask = cv2.inRange(hsv, lower_blue, upper_blue)
-                if np.count_nonzero(mask) >= 10:
-                    self.inches = i
-                    return i
+
+        # One conversion of the region under the boxes, every box is counted from the same masks
+        boxes, (x0, y0, x1, y1) = self.box_region()
+        hsv = cv2.cvtColor(self.im[y0:y1, x0:x1], cv2.COLOR_RGB2HSV)
+        pink = lib.box_counts(cv2.inRange(hsv, lower_pink, upper_pink), boxes, (x0, y0))
+        blue = lib.box_counts(cv2.inRange(hsv, lower_blue, upper_blue), boxes, (x0, y0))
+
+        # Below 6", check count of hsv pink pixels
+        # 6" and above, check count of im blue pixels
+        hits = np.where(np.arange(len(boxes)) < 6, pink > self.scaled_area(1000), blue >= self.scaled_area(10))
+        i = lib.first_hit(hits)
+        if i >= 0:
+            self.inches = i
+            return i
 
     def draw_boxes(self):
         for i in self.boxes:
             cv2.rectangle(self.im, self.boxes[i][0], self.boxes[i][1], (0, 255, 0), 5)
 
+    def attach_resort_text(self):
+        self.attach_inches_text(320, 3100, f'VAIL\n{self.inches}"', 'right', 'rs', 400)
 
-def run_vail():
-    im = None
 
+def run_vail(im=None, time=None, cached=True):
     # No-snow reference image
     # im = Image.open(join('vail', 'vail-official-snow-stake~640_2022_12_14_13_10_00_00.jpg'))
 
@@ -108,16 +119,7 @@ def run_vail():
     # im = Image.open(join('vail', 'vail-official-snow-stake~640_2022_12_14_13_05_00_00.jpg'),
     #                 x_adjust=-25, y_adjust=5, rotation=-0.5)
 
-    s = Vail(im)
-    s.auto_adjust()
-    s.create_boxes()
-    s.detect_snow()
-    # s.draw_boxes()
-    s.draw_snowline()
-    s.resize_and_crop()
-    s.attach_datetime_text(10, 50, 'left', 'la', 200)
-    s.attach_inches_text(320, 3100, f'VAIL\n{s.inches}"', 'right', 'rs', 400)
-    return s
+    return Vail(im, time=time).run(cached)
 
 
 def get_image():
@@ -126,9 +128,36 @@ def get_image():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vail snow stake, refreshed every 5 minutes')
+    parser.add_argument('--headless', action='store_true', help='serve frames over HTTP instead of showing them')
+    parser.add_argument('--replay', action='store_true', help='replay stored frames with no network access')
+    parser.add_argument('--start', type=backfill.parse_time, help='UTC start of the replay, defaults to an hour ago')
+    parser.add_argument('--end', type=backfill.parse_time, help='UTC end of the replay, defaults to now')
+    parser.add_argument('--interval', type=float, default=1, help='seconds between replayed frames')
+    args = parser.parse_args()
+
+    frames = None
+    if args.headless:
+        frames = server.FrameServer()
+        frames.start()
+
+    def output(s):
+        if frames:
+            frames.publish('vail', s.im)
+        else:
+            s.show()
+
+    # Old frames are calibrated individually and leave the live calibration alone
+    # Paced and limited to a range, every frame opens a viewer unless headless
+    if args.replay:
+        start = args.start or datetime.now(timezone.utc) - timedelta(hours=1)
+        for frame_time, path in framestore.store().frames('vail', start, args.end):
+            output(run_vail(Image.open(path), frame_time, cached=False))
+            time.sleep(args.interval)
+        sys.exit(0)
+
     # Runs every 5 minutes, avoiding drift
     start_time = time.time()
     while True:
-        s = run_vail()
-        s.show()
+        output(run_vail())
         time.sleep(300 - ((time.time() - start_time) % 300))
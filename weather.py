@@ -1,97 +1,176 @@
 # Copyright (c) 2022, Jonathan Derrick
 # SPDX-License-Identifier: GPL-3.0-or-later
+import config
+import fetch
 import lib
+import metrics
 import cv2
-import json
+import threading
 import time
 import numpy as np
-import pandas as pd
-import requests
 from datetime import datetime, timedelta
+from functools import lru_cache
 from PIL import Image
 
-try:
-    cfg = json.load(open('config.json'))
-except Exception as e:
-    print(e)
-    exit(1)
+
+# Open-Meteo hourly fields in their default units
+hourly_dtype = np.dtype([
+    ('time', 'U16'),                # iso8601
+    ('snowfall', 'f4'),             # cm
+    ('snow_depth', 'f4'),           # m
+    ('temperature_2m', 'f4'),       # °C
+    ('windspeed_10m', 'f4'),        # km/h
+    ('winddirection_10m', 'f4'),    # °
+])
+
+
+# Holds the Open-Meteo forecast for every resort, fetched in one batched request
+# Stale data keeps being served while a background refresh runs
+class WeatherCache:
+    def __init__(self):
+        self.cfg = None
+        self.data = {}
+        self.loaded = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        # Open-Meteo accepts comma-separated coordinates and returns a list of forecasts
+        cfg = config.get()
+        latitudes = ','.join(resort.latitude for resort in cfg.resorts.values())
+        longitudes = ','.join(resort.longitude for resort in cfg.resorts.values())
+        r = fetch.get(f'https://api.open-meteo.com/v1/forecast?current_weather=true&'
+                      f'hourly={",".join(hourly_dtype.names[1:])}&'
+                      f'latitude={latitudes}&longitude={longitudes}')
+        r.raise_for_status()
+        data = r.json()
+        if isinstance(data, dict):
+            data = [data]
+        # Hourly series become arrays once here so every panel update is plain indexing
+        for forecast in data:
+            forecast['hourly'] = {col: np.asarray(forecast['hourly'][col], hourly_dtype[col])
+                                  for col in hourly_dtype.names}
+        with self.lock:
+            self.cfg = cfg
+            self.data = dict(zip(cfg.resorts, data))
+            self.loaded = time.monotonic()
+
+    def refresh(self):
+        try:
+            self.fetch()
+        except Exception as e:
+            print(e)
+        finally:
+            self.refreshing = False
+
+    def get(self, city):
+        if city not in self.data:
+            metrics.count('weather_cache', result='miss')
+            self.fetch()
+        # Expired, or the configuration was reloaded since the last fetch
+        elif time.monotonic() - self.loaded > config.get().weather_ttl or self.cfg is not config.get():
+            metrics.count('weather_cache', result='stale')
+            with self.lock:
+                start = not self.refreshing
+                self.refreshing = True
+            if start:
+                threading.Thread(target=self.refresh, daemon=True).start()
+        else:
+            metrics.count('weather_cache', result='hit')
+        return self.data[city]
+
+
+weather_cache = WeatherCache()
+
+
+# Static panel background: white canvas, border and the separators between the four forecast rows
+@lru_cache(maxsize=None)
+def panel_template(im_scale):
+    im_height = 480 * im_scale
+    im_width = 160 * im_scale
+    im = np.zeros([im_height, im_width, 3], np.uint8)
+    im.fill(255)
+    cv2.rectangle(im, (0, 0), (im_width, im_height), (0, 0, 0), im_scale)
+    for i in range(1, 4):
+        y_pos = i * 600 - 20
+        cv2.rectangle(im, (0, y_pos), (im_width, y_pos + 10), (0, 0, 0), -1)
+    im.setflags(write=False)
+    return im
 
 
 class Weather:
     def __init__(self, city):
-        self.latitude = cfg['resorts'][city]['latitude']
-        self.longitude = cfg['resorts'][city]['longitude']
+        self.city = city
         self.weather = None
         self.hourly = None
-        self.time_offset = int((time.timezone if (time.localtime().tm_isdst == 0) else time.altzone) / 60 / 60)
+        self.time_offset = 0
         self.im_scale = 5
         self.im_height = 480 * self.im_scale
         self.im_width = 160 * self.im_scale
-        self.im = np.zeros([self.im_height, self.im_width, 3], np.uint8)
-        self.im.fill(255)
-        cv2.rectangle(self.im, (0, 0), (self.im_width, self.im_height), (0, 0, 0), self.im_scale)
+        self.im = panel_template(self.im_scale).copy()
+        # Text currently drawn in each forecast row, rows are only redrawn when it changes
+        self.rows = [None] * 4
 
     def load_weather(self):
-        r = requests.get(f'https://api.open-meteo.com/v1/forecast?current_weather=true&'
-                         f'hourly=snowfall,snow_depth,temperature_2m,windspeed_10m,winddirection_10m&'
-                         f'latitude={self.latitude}&longitude={self.longitude}')
-        if r.status_code == 200:
-            data = r.json()
-            self.weather = data['current_weather']
-            # Default units of:
-            # time: iso8601
-            # snowfall: cm
-            # snow_depth: m
-            # temperature_2m: °C
-            # windspeed_10m: km / h
-            # winddirection_10m: °
-            columns = ['time', 'snowfall', 'snow_depth',
-                       'temperature_2m', 'windspeed_10m', 'winddirection_10m']
-            self.hourly = pd.DataFrame(np.zeros((4, 6)), columns=columns)
-
-            # Starting at 6AM + timezone; 6, 9, 12, 3pm
-            for col in columns:
-                for i in range(0, 4):
-                    self.hourly.at[i, col] = data['hourly'][col][self.time_offset + 6 + (3 * i)]
+        data = weather_cache.get(self.city)
+        self.time_offset = int((time.timezone if (time.localtime().tm_isdst == 0) else time.altzone) / 60 / 60)
+        self.weather = data['current_weather']
 
-    def create_image(self):
-        for i in range(1, 4):
-            y_pos = i * 600 - 20
-            cv2.rectangle(self.im, (0, y_pos), (self.im_width, y_pos + 10), (0, 0, 0), -1)
+        # Starting at 6AM + timezone; 6, 9, 12, 3pm
+        hours = self.time_offset + 6 + 3 * np.arange(4)
+        self.hourly = np.empty(4, hourly_dtype)
+        for col in hourly_dtype.names:
+            self.hourly[col] = data['hourly'][col][hours]
 
+    def create_image(self):
+        template = panel_template(self.im_scale)
         for i in range(0, 4):
-            pos_x = 60
-            pos_y = 70
             clock = datetime.fromisoformat(self.hourly['time'][i]) - timedelta(hours=self.time_offset)
             clock = clock.strftime('%H:%M')
-            self.im = lib.add_text(self.im, xy=(pos_x, pos_y + i * 600), text=clock, align='left', anchor='lt',
-                                   fill='black', stroke_fill='black', stroke_width=6,
-                                   font='LiberationSerif-Regular.ttf', font_size=240)
-
             temperature_c = int(self.hourly['temperature_2m'][i])
             temperature_f = int((temperature_c * 9 / 5) + 32)
-            self.im = lib.add_text(self.im, xy=(pos_x, pos_y + 220 + i * 600),
-                                   text=f'{temperature_f}F/{temperature_c}C',
-                                   align='left', anchor='lt',
-                                   fill='black', stroke_fill='black', stroke_width=2,
-                                   font='LiberationSerif-Regular.ttf', font_size=144)
-
             windspeed_k = int(self.hourly['windspeed_10m'][i])
             windspeed_m = int(windspeed_k * 0.6214)
             # winddirection = self.winddirection(self.hourly['winddirection_10m'][i])
-            self.im = lib.add_text(self.im, xy=(pos_x, pos_y + 370 + i * 600),
-                                   text=f'{windspeed_m}MPH/{windspeed_k}KPH', align='left', anchor='lt',
-                                   fill='black', stroke_fill='black', stroke_width=2,
-                                   font='LiberationSerif-Regular.ttf', font_size=110)
+            row = (clock, f'{temperature_f}F/{temperature_c}C', f'{windspeed_m}MPH/{windspeed_k}KPH')
+            if row == self.rows[i]:
+                continue
+
+            # Restore the row between the separators from the template and only draw its text
+            y_start = max(0, i * 600 - 10)
+            y_end = (i + 1) * 600 - 20
+            self.im[y_start:y_end] = template[y_start:y_end]
+            pos_x = 60
+            pos_y = 70 + i * 600 - y_start
+            text = lib.TextLayer()
+            text.add_text(xy=(pos_x, pos_y), text=row[0], align='left', anchor='lt',
+                          fill='black', stroke_fill='black', stroke_width=6,
+                          font='LiberationSerif-Regular.ttf', font_size=240)
+            text.add_text(xy=(pos_x, pos_y + 220), text=row[1], align='left', anchor='lt',
+                          fill='black', stroke_fill='black', stroke_width=2,
+                          font='LiberationSerif-Regular.ttf', font_size=144)
+            text.add_text(xy=(pos_x, pos_y + 370), text=row[2], align='left', anchor='lt',
+                          fill='black', stroke_fill='black', stroke_width=2,
+                          font='LiberationSerif-Regular.ttf', font_size=110)
+            self.im[y_start:y_end] = text.flush(self.im[y_start:y_end])
+            self.rows[i] = row
 
     def show(self):
         Image.fromarray(self.im).show()
 
 
+# Panels are kept per city and redrawn in place, one at a time
+panels = {}
+panels_lock = threading.Lock()
+
+
 def get_weather_image(city):
-    w = Weather(city)
-    w.load_weather()
-    w.create_image()
-    return w.im
+    with metrics.timer('weather_image', resort=city), panels_lock:
+        w = panels.get(city)
+        if w is None:
+            w = panels[city] = Weather(city)
+        w.load_weather()
+        w.create_image()
+        return w.im
 
 